@@ -22,6 +22,7 @@ import plugins.server
 import plugins.session
 import plugins.messages
 import plugins.database
+import plugins.serializer
 import aiohttp.web
 import plugins.aaa
 import base64
@@ -29,7 +30,10 @@ import typing
 
 
 async def process(
-    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
+    server: plugins.server.BaseServer,
+    request: aiohttp.web.BaseRequest,
+    session: plugins.session.SessionObject,
+    indata: dict,
 ) -> typing.Union[dict, aiohttp.web.Response]:
 
     # First, assume permalink and look up the email based on that
@@ -42,20 +46,30 @@ async def process(
     # If email was found, process the request if we are allowed to display it
     if email and isinstance(email, dict) and not email.get("deleted"):
         if plugins.aaa.can_access_email(session, email):
+            revision = email.pop("_revision", None)
             # Are we fetching an attachment?
             if not indata.get("attachment"):
+                etag = plugins.messages.make_etag(session, email["mid"], email.get("dbid"), revision)
+                headers = plugins.messages.cache_headers(session, etag, server.config.cache.http_max_age)
+                if plugins.messages.is_not_modified(request, etag):
+                    return aiohttp.web.Response(headers=headers, status=304)
                 if not email.get("gravatar"):
                     email["gravatar"] = plugins.messages.gravatar(email)
-                return email
+                headers["Content-Type"] = "application/json"
+                body = await server.runners.run(plugins.serializer.dumps, email)
+                return aiohttp.web.Response(headers=headers, status=200, body=body)
             else:
                 fid = indata.get("file")
                 for entry in email.get("attachments", []):
                     if entry.get("hash") == fid:
+                        # Attachments are stored by the hash of their contents, so never change
+                        etag = plugins.messages.make_etag(session, email["mid"], fid)
+                        headers = plugins.messages.cache_headers(session, etag, server.config.cache.http_max_age)
+                        if plugins.messages.is_not_modified(request, etag):
+                            return aiohttp.web.Response(headers=headers, status=304)
                         ct = entry.get("content_type") or "application/binary"
-                        headers = {
-                            "Content-Type": ct,
-                            "Content-Length": str(entry.get("size")),
-                        }
+                        headers["Content-Type"] = ct
+                        headers["Content-Length"] = str(entry.get("size"))
                         if "image/" not in ct and "text/" not in ct:
                             headers["Content-Disposition"] = f"attachment; filename=\"{entry.get('filename')}\""
                         try:
@@ -74,4 +88,5 @@ async def process(
 
 
 def register(server: plugins.server.BaseServer):
-    return plugins.server.Endpoint(process)
+    # Note that this is a StreamingEndpoint, as it needs the request headers for conditional requests
+    return plugins.server.StreamingEndpoint(process)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Endpoint for building mbox archives in the background, and downloading them once done"""
+import plugins.server
+import plugins.session
+import plugins.aaa
+import plugins.mbox
+import plugins.defuzzer
+import typing
+import aiohttp.web
+
+
+async def process(
+    server: plugins.server.BaseServer,
+    request: aiohttp.web.BaseRequest,
+    session: plugins.session.SessionObject,
+    indata: dict,
+) -> typing.Union[dict, aiohttp.web.Response, aiohttp.web.StreamResponse]:
+    if not server.exports.enabled:
+        return aiohttp.web.Response(headers={}, status=404, text="Export jobs are not enabled on this server")
+
+    # Checking on (or downloading) an existing export?
+    job_id = indata.get("id")
+    if job_id:
+        job = await server.exports.get(job_id)
+        # Archives may include private emails, so they are only available to the scope they were made for
+        if not job or job.scope != plugins.aaa.access_scope(session):
+            return aiohttp.web.Response(headers={}, status=404, text="Export not found")
+        if indata.get("download"):
+            if job.status != "done":
+                return aiohttp.web.Response(headers={}, status=409, text="Export is not ready yet")
+            extension = "mbox.gz" if job.gzip else "mbox"
+            headers = {
+                "Content-Type": "application/gzip" if job.gzip else "application/mbox",
+                "Content-Disposition": f"attachment; filename={job.filename}.{extension}",
+            }
+            # Sent with sendfile where available, and supports Range requests for resuming downloads
+            return aiohttp.web.FileResponse(server.exports.path(job), headers=headers)
+        return job.as_dict()
+
+    # Otherwise, request a new export
+    lid = indata.get("list", "_")
+    if lid == '*':
+        lid = 'all'
+    try:
+        query_defuzzed = plugins.defuzzer.defuzz(indata, list_override="@" in lid and lid or None)
+    except AssertionError as e:  # If defuzzer encounters syntax errors, it will throw an AssertionError
+        return aiohttp.web.Response(
+            headers={
+                "content-type": "text/plain",
+            },
+            status=500,
+            text=str(e),
+        )
+    xlist = indata.get("list", "*")
+    xdomain = indata.get("domain", "*")
+    if "@" in xlist:
+        xlist, xdomain = xlist.split("@", 1)
+    job = await server.exports.submit(
+        session,
+        query_defuzzed,
+        lists=f"<{xlist}.{xdomain}>",
+        filename=plugins.mbox.filename_stem(indata),
+        gzip=bool(indata.get("gzip")),
+    )
+    if not job:
+        return aiohttp.web.Response(
+            headers={"content-type": "text/plain", "Retry-After": "60"},
+            status=503,
+            text="Too many exports waiting to be built, please try again later",
+        )
+    return job.as_dict()
+
+
+def register(server: plugins.server.BaseServer):
+    # Note that this is a StreamingEndpoint, as downloads are sent straight from disk
+    return plugins.server.StreamingEndpoint(process)
@@ -19,9 +19,10 @@
 import asyncio
 import plugins.server
 import plugins.session
+import plugins.mbox
 import plugins.messages
+import plugins.database
 import plugins.defuzzer
-import re
 import typing
 import aiohttp.web
 import sys
@@ -29,38 +30,6 @@ if sys.version_info >= (3,8):
     from asyncio.exceptions import CancelledError
 elif sys.version_info >= (3,7):
     from asyncio import CancelledError
-import email.utils as eutils
-import datetime
-
-
-async def convert_source(session: plugins.session.SessionObject, email: dict):
-    source = await plugins.messages.get_source(session, permalink=email.get("dbid", email["mid"]))
-    if source:
-        source_as_text = source["_source"]["source"]
-        # Ensure it starts with "From "...or fake it
-        if not source_as_text.startswith("From "):
-            from_line = "From MAILER-DAEMON Thu Jan  1 00:00:00 1970\n"  # Fallback in case no date found
-            # If we have any Received: headers, we can extrapolate an approximate time from the last (top) one.
-            from_match = re.search(r"(?:[\r\n]|^)Received:\s+from[^;]+?;\s+(.+?)[\r\n]", source_as_text)
-            if from_match:
-                recv_time = eutils.parsedate_tz(from_match.group(1))
-                if recv_time:
-                    dt_tuple = datetime.datetime(*recv_time[:7])
-                    if recv_time[9]:  # If we have a timezone offset, apply via timedelta
-                        dt_tuple += datetime.timedelta(seconds=recv_time[9])
-                    # Set using ctime, as per https://datatracker.ietf.org/doc/html/rfc4155#appendix-A
-                    from_line = "From MAILER-DAEMON %s\n" % dt_tuple.ctime()
-            source_as_text = from_line + source_as_text
-        # Convert to mboxrd format
-        mboxrd_source = ""
-        line_no = 0
-        for line in source_as_text.split("\n"):
-            line_no += 1
-            if line_no > 1 and re.match(r"^>*From\s+", line):
-                line = ">" + line
-            mboxrd_source += line + "\n"
-        return mboxrd_source
-    return ""
 
 
 async def process(
@@ -73,13 +42,6 @@ async def process(
     lid = indata.get("list", "_")
     if lid == '*':
         lid = 'all'
-    domain = indata.get("domain", "_")
-    if domain == '*':
-        domain = 'all'
-    # may be provided as d= or date=
-    yyyymm = indata.get("d") or indata.get("date") # e.g. 2019-9; can also be lte=1M etc
-    q = indata.get("q")
-
     try:
         query_defuzzed = plugins.defuzzer.defuzz(indata, list_override="@" in lid and lid or None)
     except AssertionError as e:  # If defuzzer encounters syntax errors, it will throw an AssertionError
@@ -90,38 +52,71 @@ async def process(
             status=500,
             text=str(e),
         )
-    results = await plugins.messages.query(
+    if not server.export_slots:
+        return await stream_mbox(server, request, session, indata, query_defuzzed)
+    # Turn the export down right away if too many are running, rather than queueing it up
+    if server.export_slots.locked():
+        return aiohttp.web.Response(
+            headers={"content-type": "text/plain", "Retry-After": "30"},
+            status=503,
+            text="Too many exports in progress, please try again later",
+        )
+    async with server.export_slots:
+        return await stream_mbox(server, request, session, indata, query_defuzzed)
+
+
+async def stream_mbox(
+    server: plugins.server.BaseServer,
+    request: aiohttp.web.BaseRequest,
+    session: plugins.session.SessionObject,
+    indata: dict,
+    query_defuzzed: dict,
+) -> aiohttp.web.StreamResponse:
+    """Streams the results of a search to the client as an mbox archive"""
+    gzip = bool(indata.get("gzip"))
+    # Resumable exports carry a token in each email, to continue after it later on
+    resumable = bool(indata.get("resumable") or indata.get("resume"))
+    search_after = None
+    if indata.get("resume"):
+        try:
+            search_after = plugins.database.parse_cursor_token(indata["resume"])
+        except ValueError as e:
+            return aiohttp.web.Response(headers={"content-type": "text/plain"}, status=400, text=str(e))
+
+    # Read the results as we go, so only a couple of batches are held in memory at any time.
+    # Oldest emails come first, with ties broken by ID, so the order is the same on every download.
+    results = plugins.messages.iter_query(
         session,
         query_defuzzed,
         query_limit=server.config.database.max_hits,
-        epoch_order="asc"
+        metadata_only=True,  # Only the document IDs are needed to fetch the sources
+        epoch_order="asc",
+        search_after=search_after,
+        cursors=resumable,
     )
 
-    dlstem = f"{lid}_{domain}"
-    if yyyymm:
-        if len(yyyymm) == 6 and yyyymm[4] == '-': # assume yyyy-m, convert to yyyy-mm
-            yyyymm = yyyymm[0:-1] + "0" + yyyymm[-1]
-        dlstem = f"{dlstem}_{yyyymm}"
-    if q:
-        dlstem = f"{dlstem}_{q}"
-    # Figure out a sane filename stem (don't keep '.')
-    dlstem = re.sub(r"[^-_a-zA-Z0-9]+", "_", dlstem)
+    dlstem = plugins.mbox.filename_stem(indata)
     headers = {"Content-Type": "application/mbox", "Content-Disposition": f"attachment; filename={dlstem}.mbox"}
+    if gzip:
+        headers["Content-Type"] = "application/gzip"
+        headers["Content-Disposition"] += ".gz"
 
     # Return mbox archive with filename as a stream
     response = aiohttp.web.StreamResponse(status=200, headers=headers)
     response.enable_chunked_encoding()
+    if server.config.server.compression_level and not gzip:
+        response.enable_compression()  # Negotiates gzip or deflate with the client
     await response.prepare(request)
-    for email in results:
-        mboxrd_source = await convert_source(session, email)
-        # Ensure each non-empty source ends with a blank line
-        if not mboxrd_source.endswith("\n\n"):
-            mboxrd_source += "\n"
-        try:
-            async with server.streamlock:
-                await asyncio.wait_for(response.write(mboxrd_source.encode("utf-8")), timeout=5)
-        except (TimeoutError, RuntimeError, CancelledError):
-            break  # Writing stream failed, break it off.
+
+    async def write(data: typing.Union[bytes, memoryview]):
+        # Each write waits for this client alone to catch up, if need be
+        await asyncio.wait_for(response.write(data), timeout=server.config.server.write_timeout)
+
+    try:
+        await plugins.mbox.write_mbox(server, session, results, write, gzip)
+    # asyncio.TimeoutError is only an alias of the builtin TimeoutError from Python 3.11 onwards
+    except (asyncio.TimeoutError, TimeoutError, RuntimeError, CancelledError):
+        pass  # Writing stream failed, break it off.
     return response
 
 
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Endpoint that returns internal performance counters of the server, for administrators"""
+
+import plugins.server
+import plugins.session
+import aiohttp.web
+import typing
+
+
+async def process(
+    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
+) -> typing.Union[dict, aiohttp.web.Response]:
+    if not session.credentials or not session.credentials.admin:
+        return aiohttp.web.Response(headers={}, status=403, text="You need administrative access to use this feature.")
+    return {
+        "offloader": server.runners.stats(),
+        "dbpool": server.dbpool.stats(),
+        "elasticsearch": server.dbpool.health.stats(server.dbpool.client),
+        "tasks": server.data.task_timings,
+        "exports": server.exports.stats(),
+    }
+
+
+def register(server: plugins.server.BaseServer):
+    return plugins.server.Endpoint(process, needs_database=False)
@@ -22,6 +22,7 @@ import plugins.session
 import plugins.messages
 import plugins.defuzzer
 import plugins.auditlog
+import plugins.rollups
 import typing
 import aiohttp.web
 
@@ -56,12 +57,19 @@ async def process(
             assert isinstance(doc, str), "Document ID must be a string"
             email = await plugins.messages.get_email(session, permalink=doc)
             if email and isinstance(email, dict) and plugins.aaa.can_access_email(session, email):
+                email.pop("_revision", None)
                 email["deleted"] = True
+                # Responses leave out the stored preview, so put it back before saving
+                email["preview"] = (email.get("body") or "")[:plugins.messages.PREVIEW_LENGTH]
                 await session.database.index(
                     index=session.database.dbs.mbox, body=email, id=email["id"],
                 )
                 lid = email.get("list_raw", "??")
                 await plugins.auditlog.add_entry(session, action="delete", target=doc, lid=lid, log=f"Removed email {doc} from {lid} archives")
+                server.stats_cache.invalidate_list(lid)
+                server.wordcloud_cache.invalidate_list(lid)
+                await server.exports.invalidate_list(lid)
+                plugins.rollups.mark_stale(server, lid, email.get("epoch", 0))
                 delcount += 1
         return aiohttp.web.Response(headers={}, status=200, text=f"Removed {delcount} emails from archives.")
     # Editing an email in place
@@ -84,6 +92,7 @@ async def process(
 
         email = await plugins.messages.get_email(session, permalink=doc)
         if email and isinstance(email, dict) and plugins.aaa.can_access_email(session, email):
+            email.pop("_revision", None)
             email["from_raw"] = new_from
             email["from"] = new_from
             email["subject"] = new_subject
@@ -92,6 +101,7 @@ async def process(
             email["list"] = lid
             email["list_raw"] = lid
             email["body"] = new_body
+            email["preview"] = new_body[:plugins.messages.PREVIEW_LENGTH]
 
             # Save edited email
             await session.database.index(
@@ -110,6 +120,15 @@ async def process(
 
             await plugins.auditlog.add_entry(session, action="edit", target=doc, lid=lid,
                                              log= f"Edited email {doc} from {origin_lid} archives ({origin_lid} -> {lid})")
+            server.stats_cache.invalidate_list(origin_lid)
+            server.wordcloud_cache.invalidate_list(origin_lid)
+            await server.exports.invalidate_list(origin_lid)
+            server.stats_cache.invalidate_list(lid)
+            server.wordcloud_cache.invalidate_list(lid)
+            await server.exports.invalidate_list(lid)
+            # The author, list and privacy may all have changed, so count the email again on both sides
+            plugins.rollups.mark_stale(server, origin_lid, email.get("epoch", 0))
+            plugins.rollups.mark_stale(server, lid, email.get("epoch", 0))
 
             return aiohttp.web.Response(headers={}, status=200, text="Email successfully saved")
         return aiohttp.web.Response(headers={}, status=404, text="Email not found!")
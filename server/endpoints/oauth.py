@@ -84,4 +84,4 @@ async def process(
 
 
 def register(server: plugins.server.BaseServer):
-    return plugins.server.Endpoint(process)
+    return plugins.server.Endpoint(process, needs_database=False)
@@ -25,4 +25,4 @@ async def process(server: plugins.server.BaseServer, session: dict, indata: dict
 
 
 def register(server: plugins.server.BaseServer):
-    return plugins.server.Endpoint(process)
+    return plugins.server.Endpoint(process, needs_database=False)
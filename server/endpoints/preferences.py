@@ -62,7 +62,8 @@ async def process(
     # Logging out??
     if indata.get("logout"):
         # Remove session from ElasticSearch
-        await plugins.session.remove_session(session)
+        async with session.open_database():
+            await plugins.session.remove_session(session)
 
         # If stored in memory, remove from there.
         if session.cookie in server.data.sessions:
@@ -81,4 +82,4 @@ async def process(
 
 
 def register(server: plugins.server.BaseServer):
-    return plugins.server.Endpoint(process)
+    return plugins.server.Endpoint(process, needs_database=False)
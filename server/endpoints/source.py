@@ -25,7 +25,10 @@ import plugins.aaa
 
 
 async def process(
-    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
+    server: plugins.server.BaseServer,
+    request: aiohttp.web.BaseRequest,
+    session: plugins.session.SessionObject,
+    indata: dict,
 ) -> aiohttp.web.Response:
     # First, assume permalink and look up the email based on that
     email = await plugins.messages.get_email(session, permalink=indata.get("id"))
@@ -36,13 +39,20 @@ async def process(
 
     if email and isinstance(email, dict) and not email.get("deleted"):
         if plugins.aaa.can_access_email(session, email):
+            # Sources are stored by the hash of the raw email, but get hidden when the email is edited
+            etag = plugins.messages.make_etag(session, email["dbid"], email.get("_revision"))
+            headers = plugins.messages.cache_headers(session, etag, server.config.cache.http_max_age)
+            if plugins.messages.is_not_modified(request, etag):
+                return aiohttp.web.Response(headers=headers, status=304)
             source = await plugins.messages.get_source(session, permalink=email["dbid"])
             if source and not source["_source"].get("deleted"):
+                headers["Content-Type"] = "text/plain"
                 return aiohttp.web.Response(
-                    headers={"Content-Type": "text/plain"}, status=200, text=source["_source"]["source"],
+                    headers=headers, status=200, text=source["_source"]["source"],
                 )
     return aiohttp.web.Response(headers={}, status=404, text="Email not found")
 
 
 def register(server: plugins.server.BaseServer):
-    return plugins.server.Endpoint(process)
+    # Note that this is a StreamingEndpoint, as it needs the request headers for conditional requests
+    return plugins.server.StreamingEndpoint(process)
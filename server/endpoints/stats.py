@@ -21,37 +21,138 @@ import plugins.server
 import plugins.session
 import plugins.messages
 import plugins.defuzzer
+import plugins.aaa
+import plugins.cache
+import plugins.database
 import plugins.offloader
+import plugins.rollups
 import re
 import email.utils
 import typing
 import aiohttp.web
 
 PYPONY_RE_PREFIX = re.compile(r"^([a-zA-Z]+:\s*)+")
+DEFAULT_PAGE_SIZE = 100
+# Parameters that make up a search, echoed back as searchParams. Nothing else (such as pretty) changes the response.
+SEARCH_PARAMS = (
+    "list", "domain", "d", "s", "e", "date", "q", "header_from", "header_subject", "header_body", "header_to",
+)
+# Parameters that change the response besides the defuzzed query itself
+RESPONSE_PARAMS = ("list", "domain", "page_size", "cursor", "summarize", "threads_only")
 
 
 async def process(
     server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
-) -> typing.Union[dict, aiohttp.web.Response]:
+) -> typing.Union[dict, plugins.cache.CacheEntry, aiohttp.web.Response]:
 
     try:
         query_defuzzed = plugins.defuzzer.defuzz(indata)
         query_defuzzed_nodate = plugins.defuzzer.defuzz(indata, nodate=True)
     except AssertionError as e:  # If defuzzer encounters syntax errors, it will throw an AssertionError
         return aiohttp.web.Response(headers={"content-type": "text/plain",}, status=500, text=str(e))
-    results = await plugins.messages.query(
-        session, query_defuzzed, query_limit=server.config.database.max_hits, shorten=True,
-    )
 
+    # List views can be fetched a page at a time, and/or as just the thread structure without the emails.
+    # Alternatively, they can be summarized as one row per thread without fetching the emails at all.
+    summarize = bool(indata.get("summarize"))
+    threads_only = bool(indata.get("threads_only"))
+    fields = plugins.messages.THREAD_FIELDS if threads_only else None
+    cursor = indata.get("cursor")
+    page_size = 0
+    try:
+        if indata.get("page_size") or cursor:
+            page_size = int(indata.get("page_size") or DEFAULT_PAGE_SIZE)
+            assert 0 < page_size <= server.config.database.max_hits, "Invalid page size"
+            if cursor:
+                plugins.database.parse_cursor_token(cursor)
+    except (ValueError, AssertionError) as e:
+        return aiohttp.web.Response(headers={"content-type": "text/plain",}, status=400, text=str(e))
+
+    # Most list views are repeats, so check if we have already done this search for this level of access
+    access_scope = plugins.aaa.access_scope(session)
+    # Only the parameters that change the response are part of the key, so that other variations of the URL share it
+    response_params = {key: indata[key] for key in RESPONSE_PARAMS if key in indata}
+    cache_key = server.stats_cache.make_key(access_scope, query_defuzzed, response_params)
+    cached_response = server.stats_cache.get(cache_key)
+    if cached_response:
+        return cached_response
+
+    # Run the main search, activity span and word cloud at the same time.
+    results_query: typing.Awaitable
+    if summarize:
+        results_query = plugins.messages.thread_summaries(
+            session, query_defuzzed, limit=server.config.database.max_hits
+        )
+    elif page_size:
+        results_query = plugins.messages.query_page(
+            session, query_defuzzed, page_size, cursor=cursor, shorten=True, fields=fields,
+        )
+    else:
+        results_query = plugins.messages.query(
+            session, query_defuzzed, query_limit=server.config.database.max_hits, shorten=True, fields=fields,
+        )
+    subqueries = {
+        "results": plugins.messages.SubQuery(results_query),
+        "span": plugins.messages.SubQuery(plugins.messages.get_activity_span(session, query_defuzzed_nodate)),
+    }
+    # Authors of whole months of a list can be added up from the rollups, rather than from every email found
+    month_range = plugins.rollups.month_range_query(query_defuzzed)
+    if month_range and server.data.rollups:
+        # Without them, the authors are counted from the emails found instead
+        subqueries["authors"] = plugins.messages.SubQuery(
+            plugins.rollups.get_authors(session, *month_range), optional=True
+        )
+    # Word clouds are cached on their own, as they only depend on the search and are slow to compute
     wordcloud = None
+    cloud_key = server.wordcloud_cache.make_key(access_scope, query_defuzzed)
     if server.config.ui.wordcloud:
-        wordcloud = await plugins.messages.wordcloud(session, query_defuzzed)
-    oldest, youngest, active_months = await plugins.messages.get_activity_span(session, query_defuzzed_nodate)
-
-    threads = plugins.messages.ThreadConstructor(results)
-    tstruct, authors = await server.runners.run(threads.construct)
+        cached_cloud = server.wordcloud_cache.get(cloud_key)
+        if cached_cloud:
+            wordcloud = cached_cloud.value
+        else:
+            subqueries["cloud"] = plugins.messages.SubQuery(
+                plugins.messages.wordcloud(
+                    session, query_defuzzed, sample_size=server.config.ui.wordcloud_sample_size
+                ),
+                timeout=server.config.database.optional_timeout,
+                optional=True,
+            )
+    answers = await plugins.messages.fan_out(**subqueries)
+    next_cursor = None
+    summary = None
+    if summarize:
+        summary = answers["results"]
+        results = []
+    elif page_size:
+        results, next_cursor = answers["results"]
+    else:
+        results = answers["results"]
+    oldest, youngest, active_months = answers["span"]
     xlist = indata.get("list", "*")
     xdomain = indata.get("domain", "*")
+    # Past months rarely change, so keep those around for longer
+    is_closed_range = plugins.defuzzer.is_closed_range(query_defuzzed)
+    if "cloud" in subqueries:
+        wordcloud = answers.get("cloud")
+        if wordcloud is not None:
+            cloud_ttl = server.config.cache.ttl_archived if is_closed_range else server.config.cache.ttl_wordcloud
+            server.wordcloud_cache.put(cloud_key, wordcloud, cloud_ttl, lists=f"<{xlist}.{xdomain}>")
+    # If an optional part was left out, this response should not be cached
+    is_partial = server.config.ui.wordcloud and wordcloud is None
+
+    if summary:
+        tstruct = summary["threads"]
+        authors = summary["authors"]
+        hits = summary["hits"]
+        numparts = summary["numparts"]
+    else:
+        threads = plugins.messages.ThreadConstructor(results)
+        tstruct, authors = await server.runners.run_cpu(threads.construct)
+        hits = len(results)
+        numparts = len(authors)
+    # Rollups count every email, even when only a page of them was fetched
+    if answers.get("authors") is not None:
+        authors = answers["authors"]
+        numparts = len(authors)
 
     all_authors = sorted(authors.items(), key=lambda x: x[1], reverse=True)  # sort in reverse by author count
     top10_authors = []
@@ -65,24 +166,46 @@ async def process(
     for msg in results:
         plugins.messages.trim_email(msg, external=True)
 
-    return {
+    response = {
         "firstYear": oldest.year,
         "lastYear": youngest.year,
         "firstMonth": oldest.month,
         "lastMonth": youngest.month,
         "active_months": active_months,
-        "hits": len(results),
-        "numparts": len(authors),
+        "hits": hits,
+        "numparts": numparts,
         "no_threads": len(tstruct),
-        "emails": list(sorted(results, key=lambda x: x["epoch"])),
         "cloud": wordcloud,
         "participants": top10_authors,
-        "thread_struct": tstruct,
         "search_list": f"<{xlist}.{xdomain}>",
         "domain": xdomain,
         "list": f"{xlist}@{xdomain}",
-        "searchParams": indata,
+        "searchParams": {key: value for key, value in indata.items() if key in SEARCH_PARAMS + RESPONSE_PARAMS},
     }
+    if summary:
+        response["thread_summaries"] = tstruct
+    else:
+        response["thread_struct"] = tstruct
+    if not threads_only and not summary:
+        response["emails"] = list(sorted(results, key=lambda x: x["epoch"]))
+    if page_size and not summary:
+        response["cursor"] = next_cursor
+
+    if not is_partial:
+        if is_closed_range:
+            ttl = server.config.cache.ttl_archived
+        else:
+            ttl = server.config.cache.ttl_current
+        cached_response = server.stats_cache.put(
+            cache_key,
+            response,
+            ttl,
+            lists=f"<{xlist}.{xdomain}>",
+            months=plugins.defuzzer.months_covered(query_defuzzed),
+        )
+        if cached_response:
+            return cached_response
+    return response
 
 
 def register(server: plugins.server.BaseServer):
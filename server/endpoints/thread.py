@@ -31,7 +31,7 @@ async def process(
     if not email:
         email = await plugins.messages.get_email(session, messageid=indata.get("id"))
     if email and isinstance(email, dict):
-        thread, emails, pdocs = await plugins.messages.fetch_children(session, email, short=True)
+        thread, emails, pdocs = await plugins.messages.fetch_thread(session, email, short=True)
     else:
         return None
 
@@ -20,7 +20,6 @@
 import argparse
 import asyncio
 import importlib
-import json
 import os
 import sys
 import traceback
@@ -31,10 +30,14 @@ import yaml
 import uuid
 
 import plugins.background
+import plugins.cache
+import plugins.compression
 import plugins.configuration
 import plugins.database
+import plugins.exports
 import plugins.formdata
 import plugins.offloader
+import plugins.serializer
 import plugins.server
 import plugins.session
 
@@ -59,15 +62,29 @@ class Server(plugins.server.BaseServer):
         yml = yaml.safe_load(open(args.config))
         self.config = plugins.configuration.Configuration(yml)
         self.data = plugins.configuration.InterData()
+        # Serve the list data we had before a restart, until the background tasks have caught up
+        plugins.background.load_snapshot(self)
         self.handlers = dict()
-        self.dbpool = asyncio.Queue()
-        self.runners = plugins.offloader.ExecutorPool()
+        # Make a pool of database handles for async queries, sharing a single ES client
+        self.dbpool = plugins.database.DatabasePool(self.config.database, size=self.config.database.pool_size)
+        self.runners = plugins.offloader.ExecutorPool(
+            threads=self.config.server.threads, processes=self.config.server.processes
+        )
         self.server = None
-        self.streamlock = asyncio.Lock()
-
-        # Make a pool of 15 database connections for async queries
-        for _ in range(1, 15):
-            self.dbpool.put_nowait(plugins.database.Database(self.config.database))
+        # Each export streams at its own pace, but only so many of them may run at once
+        self.export_slots = None
+        if self.config.server.max_exports:
+            self.export_slots = asyncio.Semaphore(self.config.server.max_exports)
+        self.stats_cache = plugins.cache.ResponseCache(self.config.cache.stats_entries)
+        self.wordcloud_cache = plugins.cache.ResponseCache(self.config.cache.wordcloud_entries)
+        self.exports = plugins.exports.ExportCache(
+            self,
+            self.config.cache.export_dir,
+            max_entries=self.config.cache.export_entries,
+            ttl=self.config.cache.ttl_export,
+            max_hits=self.config.cache.export_max_hits,
+            workers=self.config.tasks.export_workers,
+        )
 
         # Load each URL endpoint
         for endpoint_file in os.listdir("endpoints"):
@@ -127,31 +144,45 @@ class Server(plugins.server.BaseServer):
                 # but could be an exception (that needs a traceback) OR
                 # it could be a custom response, which we just pass along to the client.
                 xhandler = self.handlers[handler]
-                if isinstance(xhandler, plugins.server.StreamingEndpoint):
-                    output = await xhandler.exec(self, request, session, indata)
-                elif isinstance(xhandler, plugins.server.Endpoint):
-                    output = await xhandler.exec(self, session, indata)
-                if session.database:
-                    self.dbpool.put_nowait(session.database)
-                    self.dbpool.task_done()
-                    session.database = None
-                if isinstance(output, aiohttp.web.Response) or isinstance(output, aiohttp.web.StreamResponse):
+                async with session.open_database(xhandler.needs_database):
+                    if isinstance(xhandler, plugins.server.StreamingEndpoint):
+                        output = await xhandler.exec(self, request, session, indata)
+                    elif isinstance(xhandler, plugins.server.Endpoint):
+                        output = await xhandler.exec(self, session, indata)
+                # Cached responses may already have been serialized and compressed
+                cache_entry = None
+                if isinstance(output, plugins.cache.CacheEntry):
+                    cache_entry = output
+                    output = cache_entry.value
+                if isinstance(output, aiohttp.web.Response):
+                    await self.compress_response(request, output)
+                    return output
+                if isinstance(output, aiohttp.web.StreamResponse):
                     return output
                 if output:
-                    jsout = await self.runners.run(json.dumps, output, indent=2)
+                    # Compact JSON by default, pretty-printed if ?pretty is set
+                    pretty = "pretty" in request.query
+                    encoding = None
+                    if self.config.server.compression_level:
+                        encoding = plugins.compression.negotiate(request)
+                    variant = f"{pretty}:{encoding}"
+                    if cache_entry and variant in cache_entry.encoded:
+                        encoding, jsout = cache_entry.encoded[variant]
+                    else:
+                        encoding, jsout = await self.encode_json(output, pretty, encoding)
+                        if cache_entry:
+                            cache_entry.encoded[variant] = (encoding, jsout)
+                    if encoding:
+                        headers["Content-Encoding"] = encoding
+                    headers["Vary"] = "Accept-Encoding"
                     headers["content-type"] = "application/json"
-                    headers["Content-Length"] = str(len(jsout))
-                    return aiohttp.web.Response(headers=headers, status=200, text=jsout)
+                    return aiohttp.web.Response(headers=headers, status=200, body=jsout)
                 return aiohttp.web.Response(
                     headers=headers, status=404, text="Content not found"
                 )
             # If a handler hit an exception, we need to print that exception somewhere,
             # either to the web client or stderr:
             except:
-                if session.database:
-                    self.dbpool.put_nowait(session.database)
-                    self.dbpool.task_done()
-                    session.database = None
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 err = "\n".join(
                     traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -178,6 +209,43 @@ class Server(plugins.server.BaseServer):
                 headers=headers, status=404, text="API Endpoint not found!"
             )
 
+    async def encode_json(
+        self, output: typing.Any, pretty: bool, encoding: typing.Optional[str]
+    ) -> typing.Tuple[typing.Optional[str], bytes]:
+        """Serializes an endpoint result, compressing it if worthwhile. Returns the encoding used and the body"""
+        jsout = await self.runners.run(plugins.serializer.dumps, output, pretty=pretty)
+        if encoding and plugins.compression.is_compressible("application/json", len(jsout)):
+            jsout = await self.runners.run(
+                plugins.compression.compress,
+                jsout,
+                encoding,
+                self.config.server.compression_level,
+                self.config.server.brotli_level,
+            )
+            return encoding, jsout
+        return None, jsout
+
+    async def compress_response(self, request: aiohttp.web.BaseRequest, response: aiohttp.web.Response):
+        """Compresses the body of a custom response from an endpoint, if it is text and the client supports it"""
+        body = response.body
+        if not self.config.server.compression_level or not isinstance(body, bytes):
+            return
+        if "Content-Encoding" in response.headers:
+            return
+        encoding = plugins.compression.negotiate(request)
+        if encoding and plugins.compression.is_compressible(response.content_type, len(body)):
+            response.body = await self.runners.run(
+                plugins.compression.compress,
+                body,
+                encoding,
+                self.config.server.compression_level,
+                self.config.server.brotli_level,
+            )
+            response.headers["Content-Encoding"] = encoding
+            response.headers.pop("Content-Length", None)
+            vary = response.headers.get("Vary")
+            response.headers["Vary"] = f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+
     async def server_loop(self, _loop: asyncio.AbstractEventLoop):  # Note, loop never used.
         self.server = aiohttp.web.Server(self.handle_request)
         runner = aiohttp.web.ServerRunner(self.server)
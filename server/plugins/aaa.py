@@ -20,6 +20,8 @@ This is the AAA library for Pony Mail codename Foal
 It handles rights management for lists.
 """
 
+import typing
+
 import plugins.session
 
 
@@ -31,9 +33,47 @@ def can_access_email(session: plugins.session.SessionObject, email) -> bool:
     # If user can access the list, they can read the email
     return can_access_list(session, email.get("list_raw"))
 
+def access_scope(session: plugins.session.SessionObject) -> str:
+    """Returns the access level of the current user, for keying cached results"""
+    if session.credentials and session.credentials.authoritative:
+        return "authoritative"
+    if session.credentials:
+        return "user"
+    return "public"
+
 def can_access_list(session: plugins.session.SessionObject, _listid) -> bool:
     """Determine if a list can be accessed by the current user"""
     # If logged in via a known oauth, we assume access for now...TO BE CHANGED
     if session.credentials and session.credentials.authoritative:
         return True
     return False
+
+def query_filter(session: plugins.session.SessionObject) -> typing.Optional[dict]:
+    """Compiles the access rights of the current user into an ES filter, or None if they can read everything.
+    This is the query-side equivalent of can_access_email: public emails OR emails from accessible private lists."""
+    if session.credentials and session.credentials.authoritative:
+        return None
+    # Emails without a private flag are considered public, as in can_access_email
+    public_only = {"bool": {"must_not": [{"term": {"private": True}}]}}
+    accessible_lists = []
+    for listname, info in session.server.data.lists.items():
+        if info.get("private") and can_access_list(session, listname):
+            # foo@bar.baz -> <foo.bar.baz>
+            accessible_lists.append("<%s>" % listname.replace("@", ".", 1))
+    if not accessible_lists:
+        return public_only
+    return {
+        "bool": {
+            "should": [public_only, {"terms": {"list_raw": sorted(accessible_lists)}}],
+            "minimum_should_match": 1,
+        }
+    }
+
+def restrict_query(session: plugins.session.SessionObject, query_bool: dict) -> dict:
+    """Returns a copy of a bool query, limited to the emails the current user can access"""
+    access_filter = query_filter(session)
+    if access_filter is None:
+        return query_bool
+    restricted = dict(query_bool)
+    restricted["filter"] = list(query_bool.get("filter", [])) + [access_filter]
+    return restricted
@@ -19,26 +19,37 @@
 
 import asyncio
 import datetime
+import json
+import os
 import re
 import sys
 import time
+import typing
 
-from elasticsearch_dsl import Search
+from elasticsearch_dsl import Q, Search
 
+import plugins.aaa
 import plugins.configuration
+import plugins.defuzzer
+import plugins.messages
+import plugins.session
 import plugins.server
 import plugins.database
+import plugins.rollups
 
 PYPONY_RE_PREFIX = re.compile(r"^([a-zA-Z]+:\s*)+")
-ACTIVITY_TIMESPAN = "now-90d"  # How far back to look for "current" activity in lists
+ACTIVITY_DAYS = 90  # How far back to look for "current" activity in lists
+ACTIVITY_TIMESPAN = f"now-{ACTIVITY_DAYS}d"
 
 
 class ProgTimer:
     start: float
     title: str
+    timings: typing.Optional[dict]
 
-    def __init__(self, title):
+    def __init__(self, title, timings: typing.Optional[dict] = None):
         self.title = title
+        self.timings = timings
 
     async def __aenter__(self):
         sys.stdout.write(
@@ -47,28 +58,39 @@ class ProgTimer:
         self.start = time.time()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        print("Done in %.2f seconds" % (time.time() - self.start))
-
-
-async def get_lists(database: plugins.configuration.DBConfig) -> dict:
+        duration = time.time() - self.start
+        print("Done in %.2f seconds" % duration)
+        # Keep track of how long each task takes, for the metrics endpoint
+        if self.timings is not None:
+            timing = self.timings.setdefault(self.title, {"runs": 0, "total_time": 0.0})
+            timing["runs"] += 1
+            timing["total_time"] = round(timing["total_time"] + duration, 3)
+            timing["last_time"] = round(duration, 3)
+            timing["last_run"] = int(self.start)
+
+
+async def get_lists(db: plugins.database.Database, use_rollups: bool = False) -> dict:
     """
 
-    :param database: a Pony Mail database configuration
+    :param db: a Pony Mail database connection
+    :param use_rollups: whether to read the monthly list rollups instead of aggregating all emails
     :return: A dictionary of all mailing lists found, and whether they are considered
              public or private
     """
-    lists = {}
-    db = plugins.database.Database(database)
     limit = 8192
+    if use_rollups:
+        since = int(time.time()) - ACTIVITY_DAYS * 86400
+        return await plugins.rollups.get_lists(db, since, limit)
+    lists = {}
 
     # Fetch aggregations of all public emails
-    s = Search(using=db.client, index=database.db_prefix + "-mbox").filter(
+    s = Search(using=db.client, index=db.dbs.mbox).filter(
         "term", private=False
     )
     s.aggs.bucket("per_list", "terms", field="list_raw", size=limit)
 
     res = await db.search(
-        index=database.db_prefix + "-mbox", body=s.to_dict(), size=0
+        index=db.dbs.mbox, body=s.to_dict(), size=0
     )
 
     for ml in res["aggregations"]["per_list"]["buckets"]:
@@ -79,13 +101,13 @@ async def get_lists(database: plugins.configuration.DBConfig) -> dict:
         }
 
     # Ditto, for private emails
-    s = Search(using=db.client, index=database.db_prefix + "-mbox").filter(
+    s = Search(using=db.client, index=db.dbs.mbox).filter(
         "term", private=True
     )
     s.aggs.bucket("per_list", "terms", field="list_raw", size=limit)
 
     res = await db.search(
-        index=database.db_prefix + "-mbox", body=s.to_dict(), size=0
+        index=db.dbs.mbox, body=s.to_dict(), size=0
     )
 
     for ml in res["aggregations"]["per_list"]["buckets"]:
@@ -96,12 +118,12 @@ async def get_lists(database: plugins.configuration.DBConfig) -> dict:
         }
 
     # Get 90 day activity, if any
-    s = Search(using=db.client, index=database.db_prefix + "-mbox")
+    s = Search(using=db.client, index=db.dbs.mbox)
     s = s.filter('range', date = {'gte': ACTIVITY_TIMESPAN})
     s.aggs.bucket("per_list", "terms", field="list_raw", size=limit)
 
     res = await db.search(
-        index=database.db_prefix + "-mbox", body=s.to_dict(), size=0
+        index=db.dbs.mbox, body=s.to_dict(), size=0
     )
 
     for ml in res["aggregations"]["per_list"]["buckets"]:
@@ -109,22 +131,19 @@ async def get_lists(database: plugins.configuration.DBConfig) -> dict:
         if list_name in lists:
             lists[list_name]["count"] = ml["doc_count"]
 
-    await db.client.close()
-
     return lists
 
 
-async def get_public_activity(database: plugins.configuration.DBConfig) -> dict:
+async def get_public_activity(db: plugins.database.Database) -> dict:
     """
 
-    :param database: a PyPony database configuration
+    :param db: a PyPony database connection
     :return: A dictionary with activity stats
     """
-    db = plugins.database.Database(database)
 
     # Fetch aggregations of all public emails
     s = (
-        Search(using=db, index=database.db_prefix + "-mbox")
+        Search(using=db, index=db.dbs.mbox)
         .query("match", private=False)
         .filter("range", date={"lt": "now+1d", "gt": "now-14d"})
     )
@@ -134,9 +153,15 @@ async def get_public_activity(database: plugins.configuration.DBConfig) -> dict:
     s.aggs.bucket(
         "daily_emails", "date_histogram", field="date", calendar_interval="1d"
     )
+    # Emails archived with thread information can have their threads counted by ES,
+    # the rest we need to look at ourselves.
+    s.aggs.bucket("threaded", "filter", filter=~Q(plugins.messages.NO_THREAD_INFO)).metric(
+        "number_of_threads", "cardinality", field="thread"
+    )
+    s.aggs.bucket("unthreaded", "filter", filter=Q(plugins.messages.NO_THREAD_INFO))
 
     res = await db.search(
-        index=database.db_prefix + "-mbox", body=s.to_dict(), size=0
+        index=db.dbs.mbox, body=s.to_dict(), size=0
     )
 
     no_emails = res["hits"]["total"]["value"]
@@ -146,63 +171,285 @@ async def get_public_activity(database: plugins.configuration.DBConfig) -> dict:
     for entry in res["aggregations"]["daily_emails"]["buckets"]:
         daily_emails.append((entry["key"], entry["doc_count"]))
 
-    # Now the nitty gritty thread count
-    seen_emails = {}
-    seen_topics = []
-    thread_count = 0
+    thread_count = res["aggregations"]["threaded"]["number_of_threads"]["value"]
+    if res["aggregations"]["unthreaded"]["doc_count"]:
+        s = (
+            Search(using=db.client, index=db.dbs.mbox)
+            .query("match", private=False)
+            .filter("range", date={"lt": "now+1d", "gt": "now-14d"})
+            .filter(Q(plugins.messages.NO_THREAD_INFO))
+        )
+        thread_count += await count_topics(db, s.to_dict())
 
-    s = (
-        Search(using=db.client, index=database.db_prefix + "-mbox")
-        .query("match", private=False)
-        .filter("range", date={"lt": "now+1d", "gt": "now-14d"})
-    )
+    activity = {
+        "hits": no_emails,
+        "no_threads": thread_count,
+        "no_active_lists": no_lists,
+        "participants": no_senders,
+        "activity": daily_emails,
+    }
+
+    return activity
+
+
+async def count_topics(db: plugins.database.Database, query: dict) -> int:
+    """
+    Counts the threads among emails without thread information, by following replies and references
+    and otherwise grouping on subject. Emails are streamed in order, so replies can find their parents.
+    """
+    seen_emails = set()
+    seen_topics = set()
+    thread_count = 0
+    query["sort"] = [{"epoch": "asc"}]
     async for doc in db.scan(
-        index=database.db_prefix + "-mbox",
-        query=s.to_dict(),
+        index=db.dbs.mbox,
+        query=query,
+        preserve_order=True,
         _source_includes=[
             "message-id",
             "in-reply-to",
             "subject",
             "references",
-            "epoch",
             "list_raw",
         ],
     ):
-
-        found = False
         message_id = doc["_source"].get("message-id")
         irt = doc["_source"].get("in-reply-to")
-        references = doc["_source"].get("references")
-        list_raw = doc["_source"].get("list_raw", "_")
-        subject = doc["_source"].get("subject", "_")
-        if irt and irt in seen_emails:
-            seen_emails[message_id] = irt
-            found = True
-        elif references:
-            for refid in re.split(r"\s+", references):
-                if refid in seen_emails:
-                    seen_emails[message_id] = refid
-                    found = True
-        if not found:
-            subject = PYPONY_RE_PREFIX.sub("", subject)
-            subject += list_raw
-            if subject in seen_topics:
-                seen_emails[message_id] = subject
-            else:
-                seen_topics.append(subject)
-                thread_count += 1
-
-    await db.client.close()
+        references = doc["_source"].get("references") or ""
+        if message_id:
+            seen_emails.add(message_id)
+        if (irt and irt in seen_emails) or any(refid in seen_emails for refid in references.split()):
+            continue
+        topic = PYPONY_RE_PREFIX.sub("", doc["_source"].get("subject") or "_") + doc["_source"].get("list_raw", "_")
+        if topic not in seen_topics:
+            seen_topics.add(topic)
+            thread_count += 1
+    return thread_count
+
+
+async def get_watermark(db: plugins.database.Database) -> int:
+    """Returns the latest _archived_at timestamp in the archive"""
+    res = await db.search(
+        index=db.dbs.mbox, size=0, body={"aggs": {"latest": {"max": {"field": "_archived_at"}}}}
+    )
+    return int(res["aggregations"]["latest"]["value"] or 0)
 
-    activity = {
-        "hits": no_emails,
-        "no_threads": thread_count,
-        "no_active_lists": no_lists,
-        "participants": no_senders,
-        "activity": daily_emails,
+
+async def get_new_emails(
+    db: plugins.database.Database, watermark: int, overlap: int = 0
+) -> typing.Tuple[int, int, typing.Dict[str, typing.List[str]]]:
+    """
+    Finds the lists that have received emails since the watermark, along with the months (YYYY-MM)
+    those emails were sent in. Returns the new watermark, the number of emails found and the lists.
+    Emails can become searchable a while after their _archived_at time, so the search starts
+    $overlap seconds before the watermark. Lists are counted again, so looking twice does no harm.
+    """
+    res = await db.search(
+        index=db.dbs.mbox,
+        size=0,
+        body={
+            "query": {"range": {"_archived_at": {"gte": watermark - overlap}}},
+            "aggs": {
+                "per_list": {
+                    "terms": {"field": "list_raw", "size": 8192},
+                    "aggs": {
+                        # The date field holds the same moment as the epoch, in a form ES can bucket by month
+                        "months": {
+                            "date_histogram": {
+                                "field": "date", "calendar_interval": "month", "format": "yyyy-MM", "min_doc_count": 1
+                            }
+                        }
+                    },
+                },
+                "latest": {"max": {"field": "_archived_at"}},
+            },
+        },
+    )
+    hits = res["hits"]["total"]["value"]
+    if not hits:
+        return watermark, 0, {}
+    changed_lists = {
+        bucket["key"]: [month["key_as_string"] for month in bucket["months"]["buckets"]]
+        for bucket in res["aggregations"]["per_list"]["buckets"]
     }
+    return max(int(res["aggregations"]["latest"]["value"] or 0), watermark), hits, changed_lists
 
-    return activity
+
+async def get_list_updates(db: plugins.database.Database, list_raws: typing.List[str]) -> dict:
+    """Same as get_lists, but only for the given lists (e.g. <dev.example.org>)"""
+    s = Search(using=db.client, index=db.dbs.mbox).filter("terms", list_raw=list_raws)
+    per_list = s.aggs.bucket("per_list", "terms", field="list_raw", size=len(list_raws))
+    per_list.metric("private", "max", field="private")
+    per_list.bucket("recent", "filter", filter=Q("range", date={"gte": ACTIVITY_TIMESPAN}))
+
+    res = await db.search(
+        index=db.dbs.mbox, body=s.to_dict(), size=0
+    )
+    lists = {}
+    for ml in res["aggregations"]["per_list"]["buckets"]:
+        list_name = ml["key"].strip("<>").replace(".", "@", 1)
+        lists[list_name] = {
+            "count": ml["recent"]["doc_count"],
+            "private": bool(ml["private"]["value"]),
+        }
+    return lists
+
+
+def invalidate_new_emails(server: plugins.server.BaseServer, changed_lists: typing.Dict[str, typing.List[str]]):
+    """
+    Drops cached responses covering the months that new emails were sent in, per list.
+    Emails imported into past months are caught as well as newly arrived ones.
+    """
+    for list_raw, months in changed_lists.items():
+        for month in months:
+            server.stats_cache.invalidate_list(list_raw, month)
+
+
+async def precompute_wordclouds(server: plugins.server.BaseServer, db: plugins.database.Database):
+    """Computes the word clouds for the default view of the busiest public lists, so visitors don't have to wait"""
+    session = plugins.session.SessionObject(server)
+    session.database = db
+    public_lists = [(entry["count"], list_name) for list_name, entry in server.data.lists.items() if not entry["private"]]
+    for _count, list_name in sorted(public_lists, reverse=True)[: server.config.tasks.wordclouds]:
+        listpart, domain = list_name.split("@", 1)
+        query_defuzzed = plugins.defuzzer.defuzz({"list": listpart, "domain": domain})
+        # Same key as used by the stats endpoint
+        cloud_key = server.wordcloud_cache.make_key(plugins.aaa.access_scope(session), query_defuzzed)
+        if cloud_key in server.wordcloud_cache:
+            continue
+        wordcloud = await plugins.messages.wordcloud(
+            session, query_defuzzed, sample_size=server.config.ui.wordcloud_sample_size
+        )
+        server.wordcloud_cache.put(
+            cloud_key, wordcloud, server.config.cache.ttl_wordcloud, lists="<%s>" % list_name.replace("@", ".", 1)
+        )
+
+
+def save_snapshot(server: plugins.server.BaseServer):
+    """Writes the current list and activity data to the snapshot file, if enabled"""
+    snapshot_file = server.config.tasks.snapshot_file
+    if not snapshot_file:
+        return
+    snapshot = {
+        "saved": int(time.time()),
+        "lists": server.data.lists,
+        "activity": server.data.activity,
+        "rollups": server.data.rollups,
+    }
+    # Write to a temporary file first, so a crash can never leave a half-written snapshot behind
+    tmp_file = f"{snapshot_file}.tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, snapshot_file)
+    except OSError as e:
+        print("Could not save snapshot to %s: %s" % (snapshot_file, e))
+
+
+def load_snapshot(server: plugins.server.BaseServer):
+    """Loads list and activity data from the snapshot file, if there is one"""
+    snapshot_file = server.config.tasks.snapshot_file
+    if not snapshot_file or not os.path.exists(snapshot_file):
+        return
+    try:
+        with open(snapshot_file, "r") as f:
+            snapshot = json.load(f)
+        server.data.lists = snapshot["lists"]
+        server.data.activity = snapshot["activity"]
+        server.data.rollups = snapshot.get("rollups", False)
+        print("Loaded %u lists from snapshot saved at %s" % (len(server.data.lists), time.ctime(snapshot["saved"])))
+    except (OSError, ValueError, KeyError) as e:
+        print("Could not load snapshot from %s: %s" % (snapshot_file, e))
+
+
+async def refresh_activity(server: plugins.server.BaseServer, db: plugins.database.Database):
+    async with ProgTimer("Gathering bi-weekly activity stats", server.data.task_timings):
+        try:
+            server.data.activity = await get_public_activity(db)
+        except plugins.database.DBError as e:
+            print(
+                "Could not fetch activity data - database down or not connected: %s"
+                % e
+            )
+
+
+async def refresh_all(server: plugins.server.BaseServer, db: plugins.database.Database) -> bool:
+    """Recomputes all list and activity data. Returns False if that could not be done"""
+    async with ProgTimer("Gathering list of archived mailing lists", server.data.task_timings):
+        try:
+            # Get the watermark first, so anything archived while we work is picked up next time
+            watermark = await get_watermark(db)
+            server.data.rollups = await plugins.rollups.available(db)
+            lists = await get_lists(db, use_rollups=server.data.rollups)
+            # Nothing can have been cached yet before the first run
+            if server.data.watermark:
+                _watermark, _hits, changed_lists = await get_new_emails(
+                    db, server.data.watermark, server.config.tasks.watermark_overlap
+                )
+                invalidate_new_emails(server, changed_lists)
+            server.data.lists = lists
+            server.data.watermark = watermark
+            # Nothing has been counted around the new watermark yet, so the next check cannot be skipped
+            server.data.watermark_hits = -1
+        except plugins.database.DBError as e:
+            print("Could not fetch lists - database down or not connected: %s" % e)
+            return False
+    await refresh_activity(server, db)
+    save_snapshot(server)
+    return True
+
+
+async def refresh_changes(server: plugins.server.BaseServer, db: plugins.database.Database):
+    """Updates the data of lists that have received emails since the last run, if any"""
+    async with ProgTimer("Checking for new emails", server.data.task_timings):
+        try:
+            watermark, hits, changed_lists = await get_new_emails(
+                db, server.data.watermark, server.config.tasks.watermark_overlap
+            )
+            # The overlap finds the latest emails again and again, until newer ones come in.
+            # If nothing was added since the last check, there is nothing to update.
+            if watermark == server.data.watermark and hits == server.data.watermark_hits:
+                changed_lists = {}
+            if changed_lists:
+                lists = dict(server.data.lists)
+                lists.update(await get_list_updates(db, list(changed_lists)))
+                server.data.lists = lists
+                invalidate_new_emails(server, changed_lists)
+            server.data.watermark = watermark
+            server.data.watermark_hits = hits
+        except plugins.database.DBError as e:
+            print("Could not check for new emails - database down or not connected: %s" % e)
+            return
+    if changed_lists:
+        await refresh_activity(server, db)
+        save_snapshot(server)
+
+
+async def refresh_rollups(server: plugins.server.BaseServer, db: plugins.database.Database):
+    """Recomputes the rollups of lists and months whose emails were deleted or moved through the management API"""
+    if not server.data.stale_rollups:
+        return
+    stale_rollups, server.data.stale_rollups = server.data.stale_rollups, set()
+    changed_lists = set()
+    async with ProgTimer("Recomputing rollups of edited lists", server.data.task_timings):
+        for list_raw, month in sorted(stale_rollups):
+            try:
+                if await plugins.rollups.rebuild(db, list_raw, month):
+                    changed_lists.add(list_raw)
+                    # Cached responses may have been built from the rollup before it was recomputed
+                    server.stats_cache.invalidate_list(list_raw, month)
+                else:
+                    server.data.stale_rollups.add((list_raw, month))  # Updated by the archiver meanwhile, retry
+            except plugins.database.DBError as e:
+                print("Could not recompute rollup of %s for %s: %s" % (list_raw, month, e))
+                server.data.stale_rollups.add((list_raw, month))
+        if changed_lists:
+            try:
+                lists = dict(server.data.lists)
+                lists.update(await get_list_updates(db, list(changed_lists)))
+                server.data.lists = lists
+            except plugins.database.DBError as e:
+                print("Could not update lists - database down or not connected: %s" % e)
 
 
 async def run_tasks(server: plugins.server.BaseServer):
@@ -212,18 +459,22 @@ async def run_tasks(server: plugins.server.BaseServer):
 
         Generally runs every 2½ minutes, or whatever is set in tasks/refresh_rate in ponymail.yaml
     """
+    # Background tasks use the shared ES client, but don't take handles away from the request pool
+    db = server.dbpool.shared()
+    last_full_refresh = 0.0
     while True:
-        async with ProgTimer("Gathering list of archived mailing lists"):
-            try:
-                server.data.lists = await get_lists(server.config.database)
-            except plugins.database.DBError as e:
-                print("Could not fetch lists - database down or not connected: %s" % e)
-        async with ProgTimer("Gathering bi-weekly activity stats"):
-            try:
-                server.data.activity = await get_public_activity(server.config.database)
-            except plugins.database.DBError as e:
-                print(
-                    "Could not fetch activity data - database down or not connected: %s"
-                    % e
-                )
+        # Recompute everything every now and then, as activity counts shift over time.
+        # In between, only look at the lists that have received new emails.
+        if time.time() - last_full_refresh >= server.config.tasks.full_refresh_rate:
+            if await refresh_all(server, db):
+                last_full_refresh = time.time()
+        else:
+            await refresh_changes(server, db)
+        await refresh_rollups(server, db)
+        if server.config.ui.wordcloud and server.config.tasks.wordclouds:
+            async with ProgTimer("Computing word clouds for busy lists", server.data.task_timings):
+                try:
+                    await precompute_wordclouds(server, db)
+                except plugins.database.DBError as e:
+                    print("Could not compute word clouds - database down or not connected: %s" % e)
         await asyncio.sleep(server.config.tasks.refresh_rate)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the response cache library for Pony Mail codename Foal.
+It keeps a bounded number of computed responses in memory, evicting
+the least recently used ones first.
+"""
+
+import collections
+import fnmatch
+import json
+import time
+import typing
+
+
+class CacheEntry:
+    value: typing.Any
+    expires: float
+    lists: str
+    months: typing.Tuple[str, str]
+    encoded: typing.Dict[str, typing.Tuple[typing.Optional[str], bytes]]
+
+    def __init__(self, value: typing.Any, ttl: int, lists: str, months: typing.Optional[typing.Tuple[str, str]] = None):
+        self.value = value
+        self.expires = time.time() + ttl
+        self.lists = lists
+        # First and last month (YYYY-MM) the value may include emails from, all of them if not known
+        self.months = months or ("0000-00", "9999-99")
+        # Serialized (and possibly compressed) forms of the value, as (content encoding, body),
+        # so repeat hits can skip that work
+        self.encoded = {}
+
+
+class ResponseCache:
+    """An LRU cache of responses, with a time-to-live per entry and invalidation by list"""
+
+    def __init__(self, max_entries: int = 500):
+        self.max_entries = max_entries
+        self.entries: typing.OrderedDict[str, CacheEntry] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*args) -> str:
+        """Turns a set of query parameters into a canonical cache key"""
+        return json.dumps(args, sort_keys=True)
+
+    def get(self, key: str) -> typing.Optional[CacheEntry]:
+        """Returns a cache entry, or None if not cached or expired"""
+        entry = self.entries.get(key)
+        if entry is None or entry.expires < time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def __contains__(self, key: str) -> bool:
+        """Checks whether a key is cached and not expired, without counting it as a hit or miss"""
+        entry = self.entries.get(key)
+        return entry is not None and entry.expires >= time.time()
+
+    def put(
+        self, key: str, value: typing.Any, ttl: int, lists: str = "*", months: typing.Optional[typing.Tuple[str, str]] = None
+    ) -> typing.Optional[CacheEntry]:
+        """
+        Caches a value for $ttl seconds. The lists glob (e.g. <*.apache.org>) and the span of months
+        (first and last, YYYY-MM) the value covers are used for invalidation.
+        """
+        if self.max_entries < 1 or ttl < 1:
+            return None
+        entry = CacheEntry(value, ttl, lists, months)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def invalidate_list(self, list_raw: str, month: typing.Optional[str] = None):
+        """
+        Removes all entries that may include emails from a given list, e.g. <dev.apache.org>,
+        or only those that cover a given month (YYYY-MM) if specified
+        """
+        for key, entry in list(self.entries.items()):
+            if fnmatch.fnmatch(list_raw, entry.lists):
+                if month is None or entry.months[0] <= month <= entry.months[1]:
+                    del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
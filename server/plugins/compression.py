@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the response compression library for Pony Mail codename Foal.
+It picks a content encoding the client supports (brotli if installed, or gzip)
+and compresses response bodies with it.
+"""
+
+import gzip
+import typing
+
+import aiohttp.web
+
+try:
+    import brotli
+    HAVE_BROTLI = True
+except ImportError:
+    HAVE_BROTLI = False
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_TYPES = ("application/json", "application/mbox", "text/")
+
+
+def negotiate(request: aiohttp.web.BaseRequest) -> typing.Optional[str]:
+    """Returns the preferred content encoding accepted by the client, if any"""
+    accepted = set()
+    for entry in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = entry.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    if HAVE_BROTLI and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def is_compressible(content_type: str, size: int) -> bool:
+    """Determines whether a response body of a given type and size should be compressed"""
+    return size >= MIN_COMPRESS_SIZE and content_type.lower().startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(data: bytes, encoding: str, level: int, brotli_level: int) -> bytes:
+    """Compresses data with the chosen encoding, at level 1-9 for gzip or brotli_level 0-11 for brotli"""
+    if encoding == "br":
+        return brotli.compress(data, quality=brotli_level)
+    return gzip.compress(data, compresslevel=level)
@@ -17,24 +17,62 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import typing
+
+
 class ServerConfig:
     port: int
     ip: str
+    threads: typing.Optional[int]
+    processes: int
+    compression_level: int
+    brotli_level: int
+    write_timeout: int
+    max_exports: int
 
     def __init__(self, subyaml: dict):
         self.ip = subyaml.get("bind", "0.0.0.0")
         self.port = int(subyaml.get("port", 8080))
+        # Number of threads for offloading blocking tasks, defaults to min(32, os.cpu_count() + 4)
+        threads = subyaml.get("threads")
+        self.threads = int(threads) if threads else None
+        # Number of sub-processes for CPU-heavy tasks such as thread construction, 0 to use threads instead
+        self.processes = int(subyaml.get("processes", 0))
+        # gzip compression level (1-9) for responses, 0 to disable compression altogether
+        self.compression_level = int(subyaml.get("compression_level", 0))
+        # Quality (0-11) of brotli compression, used instead of gzip where the client supports it
+        self.brotli_level = int(subyaml.get("brotli_level", 5))
+        # How long a streamed response may wait for a slow client to accept more data, in seconds
+        self.write_timeout = int(subyaml.get("write_timeout", 30))
+        # Maximum number of mbox exports to stream at the same time, 0 for no limit
+        self.max_exports = int(subyaml.get("max_exports", 8))
 
 
 class TaskConfig:
     refresh_rate: int
+    full_refresh_rate: int
+    watermark_overlap: int
+    wordclouds: int
+    snapshot_file: str
+    export_workers: int
 
     def __init__(self, subyaml: dict):
         self.refresh_rate = int(subyaml.get("refresh_rate", 150))
+        # In between full refreshes, only lists that received new emails are looked at
+        self.full_refresh_rate = int(subyaml.get("full_refresh_rate", 3600))
+        # How far back (in seconds) to look for emails archived before the last check, but not searchable yet then
+        self.watermark_overlap = int(subyaml.get("watermark_overlap", 60))
+        # Number of busy public lists to compute word clouds for ahead of time, 0 to disable
+        self.wordclouds = int(subyaml.get("wordclouds", 0))
+        # File to keep the latest list data in, so it is available right away after a restart. Empty to disable.
+        self.snapshot_file = subyaml.get("snapshot_file", "")
+        # Number of export jobs to build archives for at the same time
+        self.export_workers = int(subyaml.get("export_workers", 2))
 
 
 class UIConfig:
     wordcloud: bool
+    wordcloud_sample_size: int
     mailhost: str
     sender_domains: str
     traceback: bool
@@ -43,6 +81,8 @@ class UIConfig:
 
     def __init__(self, subyaml: dict):
         self.wordcloud = bool(subyaml.get("wordcloud", False))
+        # Number of emails per shard to base word clouds on, 0 to use all emails found
+        self.wordcloud_sample_size = int(subyaml.get("wordcloud_sample_size", 500))
         self.mailhost = subyaml.get("mailhost", "")  # Default to nothing (disabled)
         self.sender_domains = subyaml.get(
             "sender_domains", ""
@@ -78,6 +118,14 @@ class DBConfig:
     url_prefix: str
     db_prefix: str
     max_hits: int
+    optional_timeout: float
+    pool_size: int
+    max_connections: int
+    keepalive_timeout: float
+    request_timeout: float
+    max_retries: int
+    retry_on_timeout: bool
+    scan_slices: int
 
     def __init__(self, subyaml: dict):
         self.dburl = str(subyaml.get("dburl", ""))
@@ -87,6 +135,48 @@ class DBConfig:
         self.url_prefix = subyaml.get("url_prefix", "")
         self.db_prefix = str(subyaml.get("db_prefix", "ponymail"))
         self.max_hits = int(subyaml.get("max_hits", 5000))
+        # How long to wait for optional parts of a response, such as word clouds, before leaving them out
+        self.optional_timeout = float(subyaml.get("optional_timeout", 5))
+        # All requests share a single ES client. pool_size is the number of requests that can use it at once,
+        # and max_connections is the number of connections it keeps open to each ES node.
+        self.pool_size = int(subyaml.get("pool_size", 14))
+        self.max_connections = int(subyaml.get("max_connections", 40))
+        self.keepalive_timeout = float(subyaml.get("keepalive_timeout", 60))  # Seconds to keep idle connections open
+        self.request_timeout = float(subyaml.get("request_timeout", 30))
+        self.max_retries = int(subyaml.get("max_retries", 3))
+        self.retry_on_timeout = bool(subyaml.get("retry_on_timeout", False))
+        # Number of slices to read large unordered searches in, in parallel. 1 reads them in a single stream.
+        self.scan_slices = int(subyaml.get("scan_slices", 1))
+
+
+class CacheConfig:
+    stats_entries: int
+    ttl_current: int
+    ttl_archived: int
+    http_max_age: int
+    wordcloud_entries: int
+    ttl_wordcloud: int
+    export_dir: str
+    export_entries: int
+    ttl_export: int
+    export_max_hits: int
+
+    def __init__(self, subyaml: dict):
+        self.stats_entries = int(subyaml.get("stats_entries", 500))  # Max number of stats responses to keep, 0 to disable
+        self.ttl_current = int(subyaml.get("ttl_current", 60))  # Cache time for results that may still change
+        self.ttl_archived = int(subyaml.get("ttl_archived", 86400))  # Cache time for months that have passed
+        # How long browsers and proxies may keep archived emails, sources and attachments before checking again
+        self.http_max_age = int(subyaml.get("http_max_age", 3600))
+        # Word clouds are approximate anyway, so they can be cached for longer than the list views they are part of
+        self.wordcloud_entries = int(subyaml.get("wordcloud_entries", 1000))
+        self.ttl_wordcloud = int(subyaml.get("ttl_wordcloud", 3600))
+        # Directory to keep the mbox archives built by export jobs in. Empty to disable export jobs.
+        self.export_dir = subyaml.get("export_dir", "")
+        self.export_entries = int(subyaml.get("export_entries", 100))  # Max number of archives to keep on disk
+        # Archives of months that have passed are kept until their lists are edited, others expire after this
+        self.ttl_export = int(subyaml.get("ttl_export", 3600))
+        # Maximum number of emails in an archive, 0 for no limit. Larger archives are cut off and marked as truncated.
+        self.export_max_hits = int(subyaml.get("export_max_hits", 0))
 
 
 class Configuration:
@@ -95,6 +185,7 @@ class Configuration:
     tasks: TaskConfig
     oauth: OAuthConfig
     ui: UIConfig
+    cache: CacheConfig
 
     def __init__(self, yml: dict):
         self.server = ServerConfig(yml.get("server", {}))
@@ -102,6 +193,7 @@ class Configuration:
         self.tasks = TaskConfig(yml.get("tasks", {}))
         self.oauth = OAuthConfig(yml.get("oauth", {}))
         self.ui = UIConfig(yml.get("ui", {}))
+        self.cache = CacheConfig(yml.get("cache", {}))
 
 
 class InterData:
@@ -112,8 +204,18 @@ class InterData:
     lists: dict
     sessions: dict
     activity: dict
+    rollups: bool
+    stale_rollups: typing.Set[typing.Tuple[str, str]]
+    watermark: int
+    watermark_hits: int
+    task_timings: dict
 
     def __init__(self):
         self.lists = {}
         self.sessions = {}
         self.activity = {}
+        self.rollups = False  # Whether the monthly list rollups are available
+        self.stale_rollups = set()  # Rollups (list, month) to recompute, as emails were deleted or moved
+        self.watermark = 0  # The latest _archived_at timestamp seen by the background tasks
+        self.watermark_hits = 0  # The number of emails found around the watermark during the last check
+        self.task_timings = {}
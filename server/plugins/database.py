@@ -19,6 +19,10 @@
 This is the Database library stub for Pony Mail codename Foal
 """
 
+import asyncio
+import base64
+import json
+import time
 import uuid
 import typing
 import elasticsearch
@@ -36,92 +40,328 @@ class DBNames:
         self.session = f"{dbprefix}-session"
         self.notification = f"{dbprefix}-notification"
         self.auditlog = f"{dbprefix}-auditlog"
+        self.rollup = f"{dbprefix}-rollup"
 
 
 DBError = elasticsearch.ElasticsearchException
 
 
+class KeepAliveConnection(elasticsearch.AIOHttpConnection):
+    """Async ES connection with a configurable keep-alive time for idle sockets"""
+
+    def __init__(self, *args, keepalive_timeout: float = 15.0, **kwargs):
+        self.keepalive_timeout = keepalive_timeout
+        super().__init__(*args, **kwargs)
+
+    async def _create_aiohttp_session(self):
+        await super()._create_aiohttp_session()
+        if self.keepalive_timeout and self.session is not None:
+            self.session.connector._keepalive_timeout = self.keepalive_timeout
+
+
+def make_client(config: plugins.configuration.DBConfig) -> elasticsearch.AsyncElasticsearch:
+    """Creates an async ES client with the connection and retry settings from the configuration"""
+    options: typing.Dict[str, typing.Any] = {
+        "maxsize": config.max_connections,
+        "timeout": config.request_timeout,
+        "max_retries": config.max_retries,
+        "retry_on_timeout": config.retry_on_timeout,
+        "connection_class": KeepAliveConnection,
+        "keepalive_timeout": config.keepalive_timeout,
+    }
+    if config.dburl:
+        return elasticsearch.AsyncElasticsearch([config.dburl, ], **options)
+    return elasticsearch.AsyncElasticsearch(
+        [
+            {
+                "host": config.hostname,
+                "port": config.port,
+                "url_prefix": config.url_prefix or "",
+                "use_ssl": config.secure,
+            },
+        ],
+        **options,
+    )
+
+
+class ClientHealth:
+    """Counters for the requests made through an ES client"""
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def stats(self, client: elasticsearch.AsyncElasticsearch) -> dict:
+        pool = client.transport.connection_pool
+        dead = getattr(pool, "dead", None)
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "total_time": round(self.total_time, 3),
+            "average_time": round(self.total_time / self.requests, 5) if self.requests else 0.0,
+            "max_time": round(self.max_time, 3),
+            "live_nodes": len(pool.connections),
+            "dead_nodes": dead.qsize() if dead is not None else 0,
+        }
+
+
 class Database:
     client: elasticsearch.AsyncElasticsearch
     config: plugins.configuration.DBConfig
     dbs: DBNames
     uuid: str
+    health: ClientHealth
 
-    def __init__(self, config: plugins.configuration.DBConfig):
+    def __init__(
+        self,
+        config: plugins.configuration.DBConfig,
+        client: typing.Optional[elasticsearch.AsyncElasticsearch] = None,
+        health: typing.Optional[ClientHealth] = None,
+    ):
         self.config = config
         self.uuid = str(uuid.uuid4())
         self.dbs = DBNames(config.db_prefix)
-        if self.config.dburl:
-            self.client = elasticsearch.AsyncElasticsearch([self.config.dburl, ])
-        else:
-            self.client = elasticsearch.AsyncElasticsearch(
-                [
-                    {
-                        "host": config.hostname,
-                        "port": config.port,
-                        "url_prefix": config.url_prefix or "",
-                        "use_ssl": config.secure,
-                    },
-                ]
-            )
+        # Use a shared client if given, otherwise set up our own
+        self.client = client or make_client(config)
+        self.health = health or ClientHealth()
+
+    async def call(self, method: typing.Callable, **kwargs):
+        """Calls an ES client method, keeping track of response times and failures"""
+        start = time.time()
+        self.health.requests += 1
+        try:
+            return await method(**kwargs)
+        except DBError:
+            self.health.failures += 1
+            raise
+        finally:
+            request_time = time.time() - start
+            self.health.total_time += request_time
+            self.health.max_time = max(self.health.max_time, request_time)
 
     async def search(self, index="", **kwargs):
         if not index:
             index = self.dbs.mbox
-        res = await self.client.search(index=index, **kwargs)
+        res = await self.call(self.client.search, index=index, **kwargs)
+        return res
+
+    async def msearch(self, index="", **kwargs):
+        if not index:
+            index = self.dbs.mbox
+        res = await self.call(self.client.msearch, index=index, **kwargs)
         return res
 
     async def get(self, index="", **kwargs):
         if not index:
             index = self.dbs.mbox
-        res = await self.client.get(index=index, **kwargs)
+        res = await self.call(self.client.get, index=index, **kwargs)
+        return res
+
+    async def mget(self, index="", **kwargs):
+        if not index:
+            index = self.dbs.mbox
+        res = await self.call(self.client.mget, index=index, **kwargs)
         return res
 
     async def delete(self, index="", **kwargs):
         if not index:
             index = self.dbs.session
-        res = await self.client.delete(index=index, **kwargs)
+        res = await self.call(self.client.delete, index=index, **kwargs)
         return res
 
     async def index(self, index="", **kwargs):
         if not index:
             index = self.dbs.session
-        res = await self.client.index(index=index, **kwargs)
+        res = await self.call(self.client.index, index=index, **kwargs)
         return res
 
+    async def open_point_in_time(self, index: str, keep_alive: str) -> typing.Optional[str]:
+        """Opens a point in time on an index, or returns None if the ES server does not support them"""
+        try:
+            resp = await self.call(self.client.open_point_in_time, index=index, keep_alive=keep_alive)
+            return resp["id"]
+        except elasticsearch.TransportError as e:
+            if e.status_code == 400:  # ES < 7.12, no point in time support
+                return None
+            raise
+
+    async def search_after(
+        self, index: str, body: dict, size: int, pit_id=None, keep_alive="1m", **kwargs
+    ) -> typing.AsyncIterator[dict]:
+        """Pages through the hits of a sorted query with search_after, within a point in time if given"""
+        body = body.copy()
+        body["track_total_hits"] = False
+        while True:
+            if pit_id:
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                resp = await self.call(self.client.search, body=body, size=size, **kwargs)
+                pit_id = resp.get("pit_id", pit_id)
+            else:
+                resp = await self.search(index=index, body=body, size=size, **kwargs)
+            hits = resp["hits"]["hits"]
+            for hit in hits:
+                yield hit
+            if len(hits) < size:
+                break
+            body["search_after"] = hits[-1]["sort"]
+
     async def scan(self,
                    query=None,
-                   scroll="5m",
+                   index="",
                    preserve_order=False,
                    size=1000,
-                   request_timeout=None,
-                   clear_scroll=True,
-                   scroll_kwargs=None,
+                   keep_alive="1m",
+                   slices=1,
+                   search_after=None,
                    **kwargs) -> typing.AsyncIterator[dict]:
-        
-        scroll_kwargs = scroll_kwargs or {}
+        """
+        Iterates over all hits of a query, without the server-side state of a scroll.
+        Ordered scans page statelessly with search_after, using the message ID as a tiebreaker,
+        so every hit can be turned into a continuation token (see cursor_token) and the scan
+        resumed later on by passing the parsed token as search_after.
+        Unordered scans read in index order from a point in time, optionally in parallel slices.
+        """
+        if not index:
+            index = self.dbs.mbox
+        query = query.copy() if query else {}
+        tiebreaker = [{"mid": "asc"}]
 
-        if not preserve_order:
-            query = query.copy() if query else {}
-            query["sort"] = "_doc"
+        if preserve_order:
+            query["sort"] = list(query.get("sort", [])) + tiebreaker
+            if search_after:
+                query["search_after"] = search_after
+            async for hit in self.search_after(index, query, size, **kwargs):
+                yield hit
+            return
 
-        # Do the search
-        resp = await self.search(
-            body=query, scroll=scroll, size=size, request_timeout=request_timeout, **kwargs
-        )
-        scroll_id = resp.get("_scroll_id")
+        if search_after:
+            raise ValueError("Continuation tokens can only be used with ordered scans")
+        pit_id = await self.open_point_in_time(index, keep_alive)
+        if not pit_id:
+            query["sort"] = tiebreaker
+            async for hit in self.search_after(index, query, size, **kwargs):
+                yield hit
+            return
 
-        # While we can scroll, fetch a page
+        query["sort"] = ["_shard_doc"]
         try:
-            while scroll_id and resp["hits"]["hits"]:
-                for hit in resp["hits"]["hits"]:
+            if slices > 1:
+                async for hit in self.sliced_search_after(index, query, size, pit_id, keep_alive, slices, **kwargs):
                     yield hit
-                resp = await self.client.scroll(
-                    body={"scroll_id": scroll_id, "scroll": scroll}, **scroll_kwargs
-                )
-                scroll_id = resp.get("_scroll_id")
+            else:
+                async for hit in self.search_after(index, query, size, pit_id, keep_alive, **kwargs):
+                    yield hit
+        # Release the point in time once done
+        finally:
+            await self.call(self.client.close_point_in_time, body={"id": pit_id}, ignore=(404,))
+
+    async def sliced_search_after(
+        self, index: str, body: dict, size: int, pit_id: str, keep_alive: str, slices: int, **kwargs
+    ) -> typing.AsyncIterator[dict]:
+        """Reads a point in time in parallel slices, yielding hits as they come in from any slice"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+
+        async def read_slice(slice_id: int):
+            try:
+                slice_body = dict(body, slice={"id": slice_id, "max": slices})
+                async for hit in self.search_after(index, slice_body, size, pit_id, keep_alive, **kwargs):
+                    await queue.put(hit)
+                await queue.put(None)
+            except DBError as e:
+                await queue.put(e)
+
+        readers = [asyncio.create_task(read_slice(slice_id)) for slice_id in range(slices)]
+        try:
+            running = slices
+            while running:
+                item = await queue.get()
+                if item is None:
+                    running -= 1
+                elif isinstance(item, DBError):
+                    raise item
+                else:
+                    yield item
+        finally:
+            for reader in readers:
+                reader.cancel()
+
 
-        # Shut down and clear scroll once done
+def cursor_token(hit: dict) -> str:
+    """Turns a hit from an ordered scan into an opaque continuation token"""
+    return base64.urlsafe_b64encode(json.dumps(hit["sort"]).encode("utf-8")).decode("ascii")
+
+
+def parse_cursor_token(token: str) -> list:
+    """
+    Turns a continuation token back into search_after values, an epoch and a message ID.
+    Raises ValueError if the token is not valid, so that it never reaches ES.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (ValueError, AttributeError):  # Not base64 encoded JSON, or not a string at all
+        values = None
+    if (
+        not isinstance(values, list)
+        or len(values) != 2
+        or not isinstance(values[0], int)
+        or isinstance(values[0], bool)
+        or not isinstance(values[1], str)
+    ):
+        raise ValueError("Invalid continuation token")
+    return values
+
+
+class DatabasePool:
+    """
+    A fixed pool of database handles sharing a single ES client, limiting how many requests
+    can use the database at once and keeping track of how long they wait for a handle.
+    """
+
+    def __init__(self, config: plugins.configuration.DBConfig, size: int = 14):
+        self.config = config
+        self.size = size
+        self.client = make_client(config)
+        self.health = ClientHealth()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        for _ in range(size):
+            self.queue.put_nowait(Database(config, client=self.client, health=self.health))
+        self.waiting = 0
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def shared(self) -> Database:
+        """Returns a database handle on the shared client, outside the pool (for background tasks)"""
+        return Database(self.config, client=self.client, health=self.health)
+
+    async def get(self) -> Database:
+        """Checks out a database connection, waiting for one to become available if need be"""
+        start = time.time()
+        self.waiting += 1
+        try:
+            db = await self.queue.get()
         finally:
-            if scroll_id and clear_scroll:
-                await self.client.clear_scroll(body={"scroll_id": [scroll_id]}, ignore=(404,))
+            self.waiting -= 1
+        wait_time = time.time() - start
+        self.checkouts += 1
+        self.total_wait += wait_time
+        self.max_wait = max(self.max_wait, wait_time)
+        return db
+
+    def put(self, db: Database):
+        """Returns a database connection to the pool"""
+        self.queue.put_nowait(db)
+        self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "available": self.queue.qsize(),
+            "waiting": self.waiting,
+            "checkouts": self.checkouts,
+            "total_wait": round(self.total_wait, 3),
+            "average_wait": round(self.total_wait / self.checkouts, 5) if self.checkouts else 0.0,
+            "max_wait": round(self.max_wait, 3),
+        }
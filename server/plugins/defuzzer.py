@@ -16,6 +16,7 @@
 # limitations under the License.
 
 import calendar
+import datetime
 import re
 import shlex
 import typing
@@ -27,6 +28,10 @@ It turns a URL search query into an ES query
 """
 
 
+# Month span of a query without (absolute) dates
+ALL_MONTHS = ("0000-00", "9999-99")
+
+
 def defuzz(formdata: dict, nodate: bool = False, list_override: typing.Optional[str] = None) -> dict:
     # Default to 30 day date range
     daterange = {"gt": "now-30d", "lt": "now+1d"}
@@ -176,3 +181,41 @@ def defuzz(formdata: dict, nodate: bool = False, list_override: typing.Optional[
         thebool["must_not"] = must_not
 
     return thebool
+
+
+def months_covered(query_defuzzed: dict) -> typing.Tuple[str, str]:
+    """
+    Returns the first and last month (YYYY-MM) a defuzzed query can include emails from.
+    Relative dates such as now-30d are treated as open-ended.
+    """
+    first, last = ALL_MONTHS
+    for entry in query_defuzzed.get("must", []):
+        daterange = entry.get("range", {}).get("date")
+        if daterange:
+            start = str(daterange.get("gt") or daterange.get("gte") or "")
+            end = str(daterange.get("lt") or daterange.get("lte") or "")
+            # Single month listing (YYYY-MM-01||/M), or start/end and dfr/dto (YYYY/MM/DD HH:MM:SS)
+            m = re.match(r"^(\d{4})[-/](\d{2})[-/]", start)
+            if m:
+                first = "%s-%s" % (m.group(1), m.group(2))
+            m = re.match(r"^(\d{4})[-/](\d{2})[-/]", end)
+            if m:
+                last = "%s-%s" % (m.group(1), m.group(2))
+    return first, last
+
+
+def is_closed_range(query_defuzzed: dict) -> bool:
+    """Determines whether a defuzzed query only covers months that have already ended"""
+    for entry in query_defuzzed.get("must", []):
+        daterange = entry.get("range", {}).get("date")
+        if daterange:
+            end = str(daterange.get("lt") or daterange.get("lte") or "now")
+            # Single month listing, YYYY-MM-01||/M
+            m = re.match(r"^(\d{4})-(\d{2})-01\|\|/M$", end)
+            if not m:
+                # Start/end or dfr/dto, YYYY/MM/DD HH:MM:SS
+                m = re.match(r"^(\d{4})/(\d{2})/\d{2} ", end)
+            if m:
+                now = datetime.datetime.utcnow()
+                return (int(m.group(1)), int(m.group(2))) < (now.year, now.month)
+    return False
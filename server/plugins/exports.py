@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This is the export job library for Pony Mail codename Foal.
+It builds mbox archives of searches in the background and keeps them on disk,
+so that repeat downloads of the same archive can be served straight from a file.
+Archives are kept per access scope, as they may include private emails.
+"""
+
+import asyncio
+import collections
+import copy
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import time
+import typing
+
+import plugins.aaa
+import plugins.defuzzer
+import plugins.mbox
+import plugins.messages
+import plugins.server
+import plugins.session
+
+JOB_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+# What clients are told about jobs that did not produce an archive. The details go to the log.
+FAILED_ERROR = "The archive could not be built, please try again later"
+STALE_ERROR = "The emails changed while the archive was being built, please request it again"
+
+
+class ExportJob:
+    """An mbox archive of a search, as seen by a given access scope"""
+
+    id: str
+    scope: str
+    query_defuzzed: dict
+    lists: str
+    filename: str
+    gzip: bool
+    closed: bool
+    status: str  # queued, running, done, failed or stale
+    created: int
+    finished: int
+    size: int
+    error: str
+    stale: bool
+    truncated: bool
+
+    def __init__(
+        self, job_id: str, scope: str, query_defuzzed: dict, lists: str, filename: str, gzip=False, closed=False
+    ):
+        self.id = job_id
+        self.scope = scope
+        self.query_defuzzed = query_defuzzed
+        self.lists = lists
+        self.filename = filename
+        self.gzip = gzip
+        self.closed = closed
+        self.status = "queued"
+        self.created = int(time.time())
+        self.finished = 0
+        self.size = 0
+        self.error = ""
+        self.stale = False  # Set if the emails changed while the archive was being built
+        self.truncated = False  # Set if the archive was cut off at the maximum number of emails
+
+    @classmethod
+    def from_dict(cls, doc: dict) -> "ExportJob":
+        job = cls(
+            doc["id"], doc["scope"], doc["query_defuzzed"], doc["lists"], doc["filename"], doc["gzip"], doc["closed"]
+        )
+        job.status = doc["status"]
+        job.created = doc["created"]
+        job.finished = doc["finished"]
+        job.size = doc["size"]
+        job.truncated = doc.get("truncated", False)
+        return job
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "scope": self.scope,
+            "query_defuzzed": self.query_defuzzed,
+            "lists": self.lists,
+            "filename": self.filename,
+            "gzip": self.gzip,
+            "closed": self.closed,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished,
+            "size": self.size,
+            "truncated": self.truncated,
+        }
+
+    def as_dict(self) -> dict:
+        """Returns the state of the job as shown to clients"""
+        return {
+            "id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished,
+            "size": self.size,
+            "filename": self.filename,
+            "error": self.error,
+            "truncated": self.truncated,
+        }
+
+    def mark_stale(self):
+        """Flags the job as outdated. Jobs that have not started yet are never run, running ones are not kept"""
+        self.stale = True
+        if self.status == "queued":
+            self.status = "stale"
+            self.error = STALE_ERROR
+
+    def expired(self, ttl: int) -> bool:
+        """
+        Archives of months that have passed never expire, those that may still receive email do.
+        Truncated archives expire as well, so they are not served as the whole search for good.
+        """
+        return self.status == "done" and (self.truncated or not self.closed) and self.finished + ttl < time.time()
+
+
+class ExportCache:
+    """
+    Export jobs by ID, along with the archives of finished jobs on disk.
+    Holds on to a bounded number of jobs, evicting the least recently used ones first.
+    """
+
+    def __init__(
+        self, server: plugins.server.BaseServer, directory: str, max_entries=100, ttl=3600, workers=2, max_hits=0
+    ):
+        self.server = server
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_hits = max_hits
+        self.workers = workers
+        self.jobs: typing.OrderedDict[str, ExportJob] = collections.OrderedDict()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks: typing.List[asyncio.Future] = []
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    @staticmethod
+    def make_id(scope: str, query_defuzzed: dict, gzip: bool) -> str:
+        """Turns the parameters of an export into a job ID, so that identical exports share an archive"""
+        return hashlib.sha256(json.dumps([scope, query_defuzzed, gzip], sort_keys=True).encode("utf-8")).hexdigest()
+
+    def path(self, job: ExportJob) -> str:
+        """Returns the location of the archive of a job"""
+        return os.path.join(self.directory, job.id + (".mbox.gz" if job.gzip else ".mbox"))
+
+    def metadata_path(self, job: ExportJob) -> str:
+        return os.path.join(self.directory, job.id + ".json")
+
+    def load(self):
+        """Picks up the archives built before a restart"""
+        jobs = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json") or not JOB_ID_RE.match(filename[:-5]):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), "r") as f:
+                    jobs.append(ExportJob.from_dict(json.load(f)))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print("Could not load export job %s: %s" % (filename, e))
+        for job in sorted(jobs, key=lambda x: x.finished):
+            if job.status == "done" and os.path.exists(self.path(job)) and not job.expired(self.ttl):
+                self.jobs[job.id] = job
+            else:
+                self.delete_files(job)
+        while len(self.jobs) > self.max_entries:
+            _job_id, job = self.jobs.popitem(last=False)
+            self.delete_files(job)
+
+    async def get(self, job_id: str) -> typing.Optional[ExportJob]:
+        """Returns an export job by ID, or None if not found or expired"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job.expired(self.ttl):
+            await self.remove(job)
+            return None
+        self.jobs.move_to_end(job_id)
+        return job
+
+    async def submit(
+        self, session: plugins.session.SessionObject, query_defuzzed: dict, lists: str, filename: str, gzip=False
+    ) -> typing.Optional[ExportJob]:
+        """
+        Queues up an export of a search, or returns the existing job if the same export was already requested.
+        Returns None if there are too many jobs waiting already.
+        """
+        scope = plugins.aaa.access_scope(session)
+        job_id = self.make_id(scope, query_defuzzed, gzip)
+        job = await self.get(job_id)
+        # Failed and outdated jobs are built anew
+        if job and job.status not in ("failed", "stale") and not job.stale:
+            return job
+        if self.queue.qsize() >= self.max_entries:
+            return None
+        job = ExportJob(
+            job_id, scope, query_defuzzed, lists, filename, gzip, closed=plugins.defuzzer.is_closed_range(query_defuzzed)
+        )
+        self.jobs[job_id] = job
+        # Jobs outlive the request, so they get a session of their own, on the shared database client
+        job_session = copy.copy(session)
+        job_session.database = self.server.dbpool.shared()
+        self.queue.put_nowait((job, job_session))
+        self.start()
+        return job
+
+    def start(self):
+        """Starts the export workers, if not running yet"""
+        if not self.tasks:
+            self.tasks = [asyncio.ensure_future(self.worker()) for _ in range(max(1, self.workers))]
+
+    async def worker(self):
+        while True:
+            job, session = await self.queue.get()
+            if not job.stale:
+                await self.run(job, session)
+
+    async def run(self, job: ExportJob, session: plugins.session.SessionObject):
+        """Builds the archive of an export job. It only replaces the previous archive once complete"""
+        job.status = "running"
+        tmp_path = "%s.%u.tmp" % (self.path(job), id(job))
+        # All file operations go through the runners, so slow disks do not hold up the event loop
+        run = self.server.runners.run
+        try:
+            # Archives are meant for whole lists and years, so they are not held to the max_hits of searches
+            results = self.limit(
+                job,
+                plugins.messages.iter_query(
+                    session,
+                    job.query_defuzzed,
+                    query_limit=self.max_hits or float("inf"),
+                    metadata_only=True,
+                    epoch_order="asc",
+                ),
+            )
+            f = await run(open, tmp_path, "wb")
+            try:
+
+                async def write(data: typing.Union[bytes, memoryview]):
+                    await run(f.write, data)
+
+                await plugins.mbox.write_mbox(self.server, session, results, write, job.gzip)
+            finally:
+                await run(f.close)
+            if job.stale:
+                await run(remove_file, tmp_path)
+                job.status = "stale"
+                job.error = STALE_ERROR
+            else:
+                await run(os.replace, tmp_path, self.path(job))
+                job.size = await run(os.path.getsize, self.path(job))
+                job.finished = int(time.time())
+                job.status = "done"
+                await run(self.save, job)
+        except Exception as e:
+            job.status = "failed"
+            job.error = FAILED_ERROR
+            print("Export job %s failed: %s" % (job.id, e))
+            await run(remove_file, tmp_path)
+        await self.evict()
+
+    async def limit(self, job: ExportJob, results: typing.AsyncIterator[dict]) -> typing.AsyncIterator[dict]:
+        """Passes on the emails of a job up to the maximum number, flagging the job as truncated if there are more"""
+        count = 0
+        async for doc in results:
+            if self.max_hits and count >= self.max_hits:
+                job.truncated = True
+                break
+            count += 1
+            yield doc
+
+    def save(self, job: ExportJob):
+        """Writes the details of a finished job next to its archive, so it can be reused after a restart"""
+        tmp_path = self.metadata_path(job) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp_path, self.metadata_path(job))
+
+    def delete_files(self, job: ExportJob):
+        """Deletes the archive of a job and its details from disk"""
+        for path in (self.path(job), self.metadata_path(job)):
+            remove_file(path)
+
+    async def remove(self, job: ExportJob):
+        """Forgets a finished job and deletes its archive"""
+        if self.jobs.get(job.id) is job:
+            del self.jobs[job.id]
+        await self.server.runners.run(self.delete_files, job)
+
+    async def evict(self):
+        """Removes the least recently used finished jobs while there are too many"""
+        for job in list(self.jobs.values()):
+            if len(self.jobs) <= self.max_entries:
+                break
+            if job.status in ("done", "failed", "stale"):
+                await self.remove(job)
+
+    async def invalidate_list(self, list_raw: str):
+        """Discards all archives that may include emails from a given list, e.g. <dev.apache.org>"""
+        for job in list(self.jobs.values()):
+            if fnmatch.fnmatch(list_raw, job.lists):
+                if job.status in ("queued", "running"):
+                    # Let it run its course, but do not keep the result.
+                    # The job stays around, so that clients checking on it learn to request it again.
+                    job.mark_stale()
+                else:
+                    await self.remove(job)
+
+    def stats(self) -> dict:
+        statuses = collections.Counter(job.status for job in self.jobs.values())
+        return {
+            "queued": statuses["queued"],
+            "running": statuses["running"],
+            "done": statuses["done"],
+            "failed": statuses["failed"],
+            "stale": statuses["stale"],
+            "size": sum(job.size for job in self.jobs.values()),
+        }
+
+
+def remove_file(path: str):
+    """Deletes a file, if it exists"""
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This is the mbox library for Pony Mail codename Foal.
+It turns the sources of the emails found by a search into an mboxrd archive,
+for streaming downloads (see endpoints/mbox.py) as well as export jobs (see plugins/exports.py).
+"""
+
+import asyncio
+import datetime
+import email.utils as eutils
+import re
+import typing
+import zlib
+
+import plugins.messages
+import plugins.server
+import plugins.session
+
+# Number of emails to fetch the sources of in a single request. The next batch is fetched while one is being sent.
+SOURCE_BATCH_SIZE = 100
+# Size of the chunks that (large) emails are written to the client in
+CHUNK_SIZE = 65536
+# Lines starting with "From ", or with ">From ", ">>From " etc., except the first line, need another ">" in mboxrd
+FROM_LINE_RE = re.compile(rb"(?<=\n)(>*From[^\S\n])")
+# The last (top) Received: header, to extrapolate an approximate time of arrival from
+RECEIVED_RE = re.compile(rb"(?:[\r\n]|^)Received:\s+from[^;]+?;\s+(.+?)[\r\n]")
+# Header added to each email of a resumable export, to pass as ?resume= to continue after that email
+RESUME_HEADER = b"X-Mbox-Resume-Token"
+
+
+def from_line(source: bytes) -> bytes:
+    """Makes up a "From " line for an email that did not come with one"""
+    from_match = RECEIVED_RE.search(source)
+    if from_match:
+        recv_time = eutils.parsedate_tz(from_match.group(1).decode("ascii", "replace"))
+        if recv_time:
+            dt_tuple = datetime.datetime(*recv_time[:7])
+            if recv_time[9]:  # If we have a timezone offset, apply via timedelta
+                dt_tuple += datetime.timedelta(seconds=recv_time[9])
+            # Set using ctime, as per https://datatracker.ietf.org/doc/html/rfc4155#appendix-A
+            return b"From MAILER-DAEMON %s\n" % dt_tuple.ctime().encode("ascii")
+    return b"From MAILER-DAEMON Thu Jan  1 00:00:00 1970\n"  # Fallback in case no date found
+
+
+def convert_source(
+    source: dict, resume_token: typing.Optional[str] = None
+) -> typing.Iterator[typing.Union[bytes, memoryview]]:
+    """
+    Converts a source document to an mboxrd entry, yielding it in chunks that can be written out as they are.
+    If a resume token is given, it is added as a header right below the "From " line.
+    """
+    source_as_bytes = plugins.messages.source_as_bytes(source)
+    # Ensure it starts with "From "...or fake it
+    if not source_as_bytes.startswith(b"From "):
+        source_as_bytes = from_line(source_as_bytes) + source_as_bytes
+    # The resume token goes on a line of its own, so end a single line source before it
+    if resume_token and b"\n" not in source_as_bytes:
+        source_as_bytes += b"\n"
+    # Convert to mboxrd format in a single pass
+    mboxrd_source = memoryview(FROM_LINE_RE.sub(rb">\1", source_as_bytes))
+    offset = 0
+    if resume_token:
+        offset = source_as_bytes.find(b"\n") + 1
+        yield mboxrd_source[:offset]
+        yield b"%s: %s\n" % (RESUME_HEADER, resume_token.encode("ascii"))
+    for offset in range(offset, len(mboxrd_source), CHUNK_SIZE):
+        yield mboxrd_source[offset:offset + CHUNK_SIZE]
+    # Ensure each source ends with a blank line
+    yield b"\n" if source_as_bytes.endswith(b"\n") else b"\n\n"
+
+
+async def next_sources(
+    session: plugins.session.SessionObject, emails: typing.AsyncIterator[dict]
+) -> typing.Optional[typing.List[typing.Tuple[dict, typing.Optional[str]]]]:
+    """
+    Reads the next batch of emails from a search and fetches their sources in order, along with
+    their resume tokens if requested. Returns None when done.
+    """
+    batch: typing.List[typing.Tuple[str, typing.Optional[str]]] = []
+    async for email in emails:
+        batch.append((email.get("dbid", email["mid"]), email.get("cursor")))
+        if len(batch) >= SOURCE_BATCH_SIZE:
+            break
+    if not batch:
+        return None
+    sources = await plugins.messages.get_sources(session, [permalink for permalink, _cursor in batch], raw=True)
+    return [(sources[permalink], cursor) for permalink, cursor in batch if permalink in sources]
+
+
+def filename_stem(indata: dict) -> str:
+    """Returns a sane file name for the mbox archive of a search, without the extension"""
+    lid = indata.get("list", "_")
+    if lid == '*':
+        lid = 'all'
+    domain = indata.get("domain", "_")
+    if domain == '*':
+        domain = 'all'
+    # may be provided as d= or date=
+    yyyymm = indata.get("d") or indata.get("date") # e.g. 2019-9; can also be lte=1M etc
+    q = indata.get("q")
+    dlstem = f"{lid}_{domain}"
+    if yyyymm:
+        if len(yyyymm) == 6 and yyyymm[4] == '-': # assume yyyy-m, convert to yyyy-mm
+            yyyymm = yyyymm[0:-1] + "0" + yyyymm[-1]
+        dlstem = f"{dlstem}_{yyyymm}"
+    if q:
+        dlstem = f"{dlstem}_{q}"
+    # Figure out a sane filename stem (don't keep '.')
+    return re.sub(r"[^-_a-zA-Z0-9]+", "_", dlstem)
+
+
+async def write_mbox(
+    server: plugins.server.BaseServer,
+    session: plugins.session.SessionObject,
+    results: typing.AsyncIterator[dict],
+    write: typing.Callable[[typing.Union[bytes, memoryview]], typing.Awaitable[typing.Any]],
+    gzip=False,
+):
+    """
+    Writes the sources of the emails found by a search to $write as an mbox archive, gzip-compressed if asked to.
+    The sources of the next batch of emails are fetched while one batch is being written.
+    """
+    compressor = None
+    if gzip:
+        compressor = zlib.compressobj(server.config.server.compression_level or 6, zlib.DEFLATED, 31)
+    fetch = asyncio.ensure_future(next_sources(session, results))
+    try:
+        while True:
+            sources = await fetch
+            if sources is None:
+                break
+            # Start fetching the next batch before writing this one
+            fetch = asyncio.ensure_future(next_sources(session, results))
+            for source, resume_token in sources:
+                for chunk in convert_source(source, resume_token):
+                    if compressor:
+                        # Compress larger chunks in a thread, so as not to hold up other requests
+                        if len(chunk) >= CHUNK_SIZE // 4:
+                            chunk = await server.runners.run(compressor.compress, chunk)
+                        else:
+                            chunk = compressor.compress(chunk)
+                    if chunk:
+                        await write(chunk)
+        if compressor:
+            await write(compressor.flush())
+    finally:
+        fetch.cancel()
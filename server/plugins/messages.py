@@ -22,26 +22,37 @@ pages that need it.
 """
 
 
+import asyncio
 import base64
 import binascii
 import datetime
 import email.utils
 import hashlib
+import json
 
 # Main imports
 import re
 import typing
 
+import aiohttp.web
 
 import plugins.aaa
 import plugins.session
 import plugins.database
+import plugins.rollups
 
 PYPONY_RE_PREFIX = re.compile(r"^([a-zA-Z]+:\s*)+")
 DATABASE_NOT_CONNECTED = "Database not connected!"
+PARTIAL_ADDRESS_RE = re.compile(r"<[^<>\s]*$")
 
 mbox_cache_privacy: typing.Dict[str, bool] = {}
 
+# Maximum number of emails to fetch when grabbing an entire thread in one go
+THREAD_MAX_DOCS = 10000
+# Maximum depth of a thread, and how many parents to look up per multi-search
+THREAD_MAX_DEPTH = 250
+THREAD_BATCH_SIZE = 100
+
 USED_UI_FIELDS = [
     "private",
     "list",
@@ -58,9 +69,50 @@ USED_UI_FIELDS = [
     "children",
 ]
 
+# Length of the body previews shown in list views
+PREVIEW_LENGTH = 200
+
+# Maximum number of thread summaries to return for a search
+THREAD_SUMMARY_LIMIT = 5000
+
+# Fields needed to build a thread structure, for searches that do not return the emails themselves
+THREAD_FIELDS = [
+    "deleted",
+    "private",
+    "mid",
+    "dbid",
+    "list_raw",
+    "message-id",
+    "in-reply-to",
+    "subject",
+    "from",
+    "epoch",
+]
+
+# Matches emails that were archived without thread information
+NO_THREAD_INFO = {
+    "bool": {"should": [{"bool": {"must_not": [{"exists": {"field": "thread"}}]}}, {"term": {"thread": ""}}]}
+}
+
+# Fields needed for list views. The body is left out in favour of a preview, see PREVIEW_SCRIPT
+LIST_VIEW_FIELDS = sorted(set(USED_UI_FIELDS + THREAD_FIELDS) - {"body"})
+
+# Returns the preview stored at archive time, or the start of the body for emails archived without one.
+# Either way, only the preview is sent over the wire.
+PREVIEW_SCRIPT = {
+    "source": "def src = params['_source']; "
+              "if (src['preview'] != null) { return src['preview']; } "
+              "def body = src['body']; "
+              "if (body == null) { return ''; } "
+              "return body.length() > params.length ? body.substring(0, params.length) : body;",
+    "params": {"length": PREVIEW_LENGTH},
+}
+
 
 def trim_email(doc, external=False):
     """Trims away document fields not used by the UI"""
+    # The stored preview is only for list views, which get it in place of the body (see summarize_hit)
+    doc.pop("preview", None)
     for header in list(doc.keys()):
         # Remove meta data fields which start with an underscore
         if header.startswith("_"):
@@ -95,10 +147,14 @@ def anonymize(doc):
         ptr["from"] = re.sub(
             r"<(\S{1,2})\S*@([-a-zA-Z0-9_.]+)>", "<\\1..@\\2>", ptr["from"]
         )
-        if ptr["body"]:
-            ptr["body"] = re.sub(
-                r"<(\S{1,2})\S*@([-a-zA-Z0-9_.]+)>", "<\\1..@\\2>", ptr["body"]
-            )
+        for field in ("body", "preview"):
+            if ptr.get(field):
+                ptr[field] = re.sub(
+                    r"<(\S{1,2})\S*@([-a-zA-Z0-9_.]+)>", "<\\1..@\\2>", ptr[field]
+                )
+        # A preview may end halfway through an email address
+        if ptr.get("preview"):
+            ptr["preview"] = PARTIAL_ADDRESS_RE.sub("", ptr["preview"])
     return doc
 
 
@@ -107,6 +163,11 @@ async def find_parent(session, doc: typing.Dict[str, str]):
     Locates the first email in a thread by going back through all the
     in-reply-to headers and finding their source.
     """
+    # If the archiver stored thread info, the origin is the email the thread is named after
+    if doc.get("thread") and doc["thread"] != doc.get("mid"):
+        newdoc = await get_email(session, permalink=doc["thread"])
+        if newdoc and plugins.aaa.can_access_email(session, newdoc):
+            return newdoc
     step = 0
     # max 50 steps up in the hierarchy
     while step < 50:
@@ -149,24 +210,9 @@ async def fetch_children(session, pdoc, counter=0, pdocs=None, short=False):
                 mykids, _myemails, pdocs = await fetch_children(
                     session, doc, counter, pdocs, short=short
                 )
-                if short:
-                    xdoc = {
-                        "tid": doc["mid"],
-                        "mid": doc["mid"],
-                        "message-id": doc["message-id"],
-                        "subject": doc["subject"],
-                        "from": doc["from"],
-                        "id": doc["mid"],
-                        "epoch": doc["epoch"],
-                        "children": mykids,
-                        "irt": doc["in-reply-to"],
-                        "list_raw": doc["list_raw"],
-                    }
-                    thread.append(xdoc)
-                    pdocs[doc["mid"]] = xdoc
-                else:
-                    thread.append(doc)
-                    pdocs[doc["mid"]] = doc
+                xdoc = thread_entry(doc, mykids, short=short)
+                thread.append(xdoc)
+                pdocs[doc["mid"]] = xdoc
                 for kid in mykids:
                     if kid["mid"] not in pdocs:
                         pdocs[kid["mid"]] = kid
@@ -174,12 +220,112 @@ async def fetch_children(session, pdoc, counter=0, pdocs=None, short=False):
     return thread, emails, pdocs
 
 
+def thread_entry(doc, kids, short=False):
+    """Turns an email into an entry in a thread structure"""
+    if short:
+        return {
+            "tid": doc["mid"],
+            "mid": doc["mid"],
+            "message-id": doc["message-id"],
+            "subject": doc["subject"],
+            "from": doc["from"],
+            "id": doc["mid"],
+            "epoch": doc["epoch"],
+            "children": kids,
+            "irt": doc["in-reply-to"],
+            "list_raw": doc["list_raw"],
+        }
+    return doc
+
+
+async def fetch_thread(session, pdoc, short=False):
+    """
+    Fetches all child messages of a parent email with a single query on the thread ID
+    stored by the archiver, and rebuilds the tree in memory. Emails without thread
+    info are handed over to fetch_children instead.
+    """
+    if not pdoc.get("thread"):
+        return await fetch_children_batched(session, pdoc, short=short)
+    docs = await get_email(session, thread=pdoc["thread"])
+    return construct_children(pdoc, docs or [], short=short)
+
+
+async def fetch_children_batched(session, pdoc, short=False):
+    """
+    Fetches all child messages of a parent email breadth-first, looking up the
+    replies to an entire level of the thread with a single multi-search.
+    Returns the same structure as fetch_children.
+    """
+    kids_by_parent: typing.Dict[str, typing.List[dict]] = {}
+    seen = {pdoc["mid"]}
+    frontier = [pdoc]
+    depth = 0
+    while frontier and depth < THREAD_MAX_DEPTH:
+        depth += 1
+        next_frontier = []
+        for i in range(0, len(frontier), THREAD_BATCH_SIZE):
+            parents = frontier[i:i + THREAD_BATCH_SIZE]
+            replies = await get_replies(session, [parent["message-id"] for parent in parents])
+            for parent, docs in zip(parents, replies):
+                for doc in docs:
+                    if doc.get("deleted") or doc["mid"] in seen:
+                        continue
+                    seen.add(doc["mid"])
+                    kids_by_parent.setdefault(parent["mid"], []).append(doc)
+                    next_frontier.append(doc)
+        frontier = next_frontier
+    return build_thread(pdoc, kids_by_parent, short=short)
+
+
+def construct_children(pdoc, docs, short=False):
+    """
+    Builds the same thread structure as fetch_children, using a list of
+    already fetched emails belonging to the thread.
+    """
+    mids_by_msgid = {doc.get("message-id"): doc["mid"] for doc in docs}
+    mids_by_msgid[pdoc.get("message-id")] = pdoc["mid"]
+    kids_by_parent: typing.Dict[str, typing.List[dict]] = {}
+    for doc in docs:
+        # Replies have their parent's mid stored in 'previous', otherwise use in-reply-to
+        if not doc.get("top") and doc.get("previous"):
+            parent = doc["previous"]
+        else:
+            parent = mids_by_msgid.get(doc.get("in-reply-to"), "")
+        if parent and parent != doc["mid"]:
+            kids_by_parent.setdefault(parent, []).append(doc)
+    return build_thread(pdoc, kids_by_parent, short=short)
+
+
+def build_thread(pdoc, kids_by_parent: typing.Dict[str, typing.List[dict]], short=False):
+    """Turns a dict of replies keyed by parent mid into the thread structure of fetch_children"""
+    pdocs: typing.Dict[str, dict] = {pdoc["mid"]: pdoc}
+
+    def walk(parent_doc):
+        thread = []
+        for doc in kids_by_parent.get(parent_doc["mid"], []):
+            if doc.get("deleted") or doc["mid"] in pdocs:
+                continue
+            pdocs[doc["mid"]] = doc  # Mark as seen before descending, to guard against loops
+            xdoc = thread_entry(doc, walk(doc), short=short)
+            thread.append(xdoc)
+            pdocs[doc["mid"]] = xdoc
+        return thread
+
+    for kids in kids_by_parent.values():
+        kids.sort(key=lambda x: x.get("epoch", 0))
+    thread = walk(pdoc)
+    del pdocs[pdoc["mid"]]
+    emails: typing.List[dict] = []
+    return thread, emails, pdocs
+
+
 async def get_email(
     session: plugins.session.SessionObject,
     permalink: str = None,
     messageid=None,
     irt=None,
     source=False,
+    thread=None,
 ):
     assert session.database, DATABASE_NOT_CONNECTED
     doctype = session.database.dbs.mbox
@@ -199,7 +345,10 @@ async def get_email(
                 index=doctype,
                 size=1,
                 body={
-                    "query": {"bool": {"must": [{aggtype: {"permalinks": permalink}}]}}
+                    "query": {"bool": plugins.aaa.restrict_query(
+                        session, {"must": [{aggtype: {"permalinks": permalink}}]}
+                    )},
+                    "seq_no_primary_term": True,
                 },
             )
             if len(res["hits"]["hits"]) == 1:
@@ -208,7 +357,12 @@ async def get_email(
         res = await session.database.search(
             index=doctype,
             size=1,
-            body={"query": {"bool": {"must": [{aggtype: {"message-id": messageid}}]}}},
+            body={
+                "query": {"bool": plugins.aaa.restrict_query(
+                    session, {"must": [{aggtype: {"message-id": messageid}}]}
+                )},
+                "seq_no_primary_term": True,
+            },
         )
         if len(res["hits"]["hits"]) == 1:
             doc = res["hits"]["hits"][0]
@@ -216,36 +370,80 @@ async def get_email(
         res = await session.database.search(
             index=doctype,
             size=250,
-            body={"query": {"bool": {"must": [{aggtype: {"in-reply-to": irt}}]}}},
+            body={"query": {"bool": plugins.aaa.restrict_query(
+                session, {"must": [{aggtype: {"in-reply-to": irt}}]}
+            )}},
+        )
+        docs = res["hits"]["hits"]
+    elif thread:
+        res = await session.database.search(
+            index=doctype,
+            size=THREAD_MAX_DOCS,
+            body={"query": {"bool": plugins.aaa.restrict_query(
+                session, {"must": [{"term": {"thread": thread}}]}
+            )}},
         )
         docs = res["hits"]["hits"]
 
     # Did we find a single doc?
     if doc and isinstance(doc, dict):
-        doc = doc["_source"]
-        doc["id"] = doc["mid"]
-        if doc and plugins.aaa.can_access_email(session, doc):
-            if not session.credentials:
-                doc = anonymize(doc)
-            trim_email(doc)
-            return doc
+        return accessible_source(session, doc)
 
     # multi-doc return?
     elif docs is not None and isinstance(docs, list):
         docs_returned = []
         for doc in docs:
-            doc = doc["_source"]
-            doc["id"] = doc["mid"]
-            if doc and plugins.aaa.can_access_email(session, doc):
-                if not session.credentials:
-                    doc = anonymize(doc)
-                trim_email(doc)
+            doc = accessible_source(session, doc)
+            if doc:
                 docs_returned.append(doc)
         return docs_returned
     # no doc?
     return None
 
 
+def accessible_source(session: plugins.session.SessionObject, hit: dict) -> typing.Optional[dict]:
+    """Returns the (anonymized if need be) document of a search hit, if the user can access it"""
+    doc = hit["_source"]
+    doc["id"] = doc["mid"]
+    if doc and plugins.aaa.can_access_email(session, doc):
+        if not session.credentials:
+            doc = anonymize(doc)
+        trim_email(doc)
+        # Keep track of the document revision, so edited emails get new ETags
+        if "_seq_no" in hit:
+            doc["_revision"] = "%s.%s" % (hit.get("_primary_term"), hit["_seq_no"])
+        return doc
+    return None
+
+
+async def get_replies(
+    session: plugins.session.SessionObject, message_ids: typing.List[str]
+) -> typing.List[typing.List[dict]]:
+    """Finds the replies to several emails in one multi-search, returning one list of emails per message-id"""
+    assert session.database, DATABASE_NOT_CONNECTED
+    if not message_ids:
+        return []
+    searches: typing.List[dict] = []
+    for message_id in message_ids:
+        searches.append({})
+        # Leave out what the user cannot access in ES, so it does not take up room among the replies returned
+        query_bool = plugins.aaa.restrict_query(session, {"must": [{"match": {"in-reply-to": message_id}}]})
+        searches.append({"size": 250, "query": {"bool": query_bool}})
+    res = await session.database.msearch(index=session.database.dbs.mbox, body=searches)
+    replies = []
+    for message_id, response in zip(message_ids, res["responses"]):
+        # A failed search would otherwise pass for an email without replies, cutting the thread short
+        if "error" in response:
+            raise plugins.database.DBError("Could not fetch the replies to %s: %s" % (message_id, response["error"]))
+        docs = []
+        for hit in response["hits"]["hits"]:
+            doc = accessible_source(session, hit)
+            if doc:
+                docs.append(doc)
+        replies.append(docs)
+    return replies
+
+
 async def get_source(session: plugins.session.SessionObject, permalink: str = None, raw=False):
     assert session.database, DATABASE_NOT_CONNECTED
     doctype = session.database.dbs.source
@@ -265,18 +463,67 @@ async def get_source(session: plugins.session.SessionObject, permalink: str = No
     if doc:
         if raw:
             return doc
-        # Check for base64-encoded source
-        if ":" not in doc["_source"]["source"]:
-            try:
-                doc["_source"]["source"] = base64.standard_b64decode(
-                    doc["_source"]["source"]
-                ).decode("utf-8", "replace")
-            except binascii.Error:
-                pass  # If it wasn't base64 after all, just return as is
-        return doc
+        return decode_source(doc)
     return None
 
 
+def decode_source(doc: dict) -> dict:
+    """Decodes the raw email of a source document, if it was stored base64-encoded"""
+    if ":" not in doc["_source"]["source"]:
+        try:
+            doc["_source"]["source"] = base64.standard_b64decode(
+                doc["_source"]["source"]
+            ).decode("utf-8", "replace")
+        except binascii.Error:
+            pass  # If it wasn't base64 after all, just return as is
+    return doc
+
+
+def source_as_bytes(doc: dict) -> bytes:
+    """Returns the raw email of a source document as bytes, decoding base64-encoded sources straight to bytes"""
+    source = doc["_source"]["source"]
+    if ":" not in source:
+        try:
+            return base64.standard_b64decode(source)
+        except binascii.Error:
+            pass  # If it wasn't base64 after all, just return as is
+    return source.encode("utf-8")
+
+
+async def get_sources(
+    session: plugins.session.SessionObject, permalinks: typing.List[str], raw=False
+) -> typing.Dict[str, dict]:
+    """
+    Fetches the sources of several emails at once, in the same way as get_source does.
+    Returns the source documents by permalink, leaving out any that could not be found.
+    If raw is set, sources are returned as stored, see source_as_bytes.
+    """
+    assert session.database, DATABASE_NOT_CONNECTED
+    doctype = session.database.dbs.source
+    sources = {}
+    res = await session.database.mget(index=doctype, body={"ids": permalinks})
+    for doc in res["docs"]:
+        if doc.get("found"):
+            sources[doc["_id"]] = doc if raw else decode_source(doc)
+    # Look up the rest by their permalink field instead, accepting unique matches only
+    missing = [permalink for permalink in permalinks if permalink not in sources]
+    if missing:
+        res = await session.database.search(
+            index=doctype,
+            size=len(missing) * 2,
+            body={"query": {"bool": {"must": [{"terms": {"permalink": missing}}]}}},
+        )
+        matches: typing.Dict[str, typing.List[dict]] = {}
+        for doc in res["hits"]["hits"]:
+            matches.setdefault(doc["_source"].get("permalink"), []).append(doc)
+        for permalink in missing:
+            if len(matches.get(permalink, [])) == 1:
+                doc = matches[permalink][0]
+                doc["id"] = doc["_id"]
+                sources[permalink] = doc if raw else decode_source(doc)
+    return sources
+
+
 def get_list(session, listid, fr=None, to=None, limit=10000):
     """
     Loads emails from a specified list.
@@ -301,6 +548,44 @@ def get_list(session, listid, fr=None, to=None, limit=10000):
     return docs
 
 
+def project_source(es_query: dict, metadata_only=False, fields=None, shorten=False):
+    """Limits a search to the document fields the caller needs, fetching a preview instead of the body if shortened"""
+    if metadata_only:  # Only doc IDs and AAA fields.
+        es_query["_source"] = ["deleted", "private", "mid", "dbid", "list_raw"]
+    elif fields:
+        es_query["_source"] = fields
+    elif shorten:
+        es_query["_source"] = LIST_VIEW_FIELDS
+        es_query["script_fields"] = {"preview": {"script": PREVIEW_SCRIPT}}
+
+
+def summarize_hit(
+    session: plugins.session.SessionObject, hit: dict, hide_deleted=True, metadata_only=False, shorten=False
+) -> typing.Optional[dict]:
+    """Returns the document of a search hit as shown in list views, or None if the user should not see it"""
+    doc = hit["_source"]
+    if "preview" in hit.get("fields", {}):  # See project_source
+        doc["body"] = hit["fields"]["preview"][0]
+    # If email was delete/hidden and we're not doing an admin query, ignore it
+    if hide_deleted and doc.get("deleted", False):
+        return None
+    doc["id"] = doc["mid"]
+    if not plugins.aaa.can_access_email(session, doc):
+        return None
+    # Calculate gravatars if not present in source
+    if not metadata_only and "gravatar" not in doc:
+        doc["gravatar"] = gravatar(doc)
+    if not session.credentials:
+        doc = anonymize(doc)
+        # A preview may end halfway through an email address, which anonymize would not catch
+        if shorten and doc.get("body"):
+            doc["body"] = PARTIAL_ADDRESS_RE.sub("", doc["body"][:PREVIEW_LENGTH])
+    if shorten:
+        doc["body"] = (doc.get("body") or "")[:PREVIEW_LENGTH]
+    trim_email(doc)
+    return doc
+
+
 async def query(
     session: plugins.session.SessionObject,
     query_defuzzed,
@@ -308,62 +593,220 @@ async def query(
     shorten=False,
     hide_deleted=True,
     metadata_only=False,
-    epoch_order="desc"
+    epoch_order="desc",
+    fields=None,
 ):
     """
     Advanced query and grab for stats.py
     """
-    docs = []
+    return [
+        doc
+        async for doc in iter_query(
+            session, query_defuzzed, query_limit, shorten, hide_deleted, metadata_only, epoch_order, fields
+        )
+    ]
+
+
+async def iter_query(
+    session: plugins.session.SessionObject,
+    query_defuzzed,
+    query_limit=10000,
+    shorten=False,
+    hide_deleted=True,
+    metadata_only=False,
+    epoch_order="desc",
+    fields=None,
+    search_after=None,
+    cursors=False,
+) -> typing.AsyncIterator[dict]:
+    """
+    Yields the results of a query one by one, as they are read from ES, rather than holding on to all of them.
+    Oldest-first results come in a fixed order, and can be resumed after any email: if cursors is set, each
+    email gets the continuation token for the results after it, which can be parsed and passed as search_after.
+    """
     hits = 0
     assert session.database, DATABASE_NOT_CONNECTED
     preserve_order = True if epoch_order == "asc" else False
+    # Leave out anything the user cannot access in ES, rather than scrolling through it
     es_query = {
-        "query": {"bool": query_defuzzed},
+        "query": {"bool": plugins.aaa.restrict_query(session, query_defuzzed)},
         "sort": [{"epoch": {"order": epoch_order}}],
     }
-    if metadata_only:  # Only doc IDs and AAA fields.
-        es_query["_source"] = ["deleted", "private", "mid", "dbid", "list_raw"]
+    project_source(es_query, metadata_only, fields, shorten)
     async for hit in session.database.scan(
         query=es_query,
-        preserve_order=preserve_order
+        preserve_order=preserve_order,
+        search_after=search_after,
+        # Without a particular order, large searches can be read in parallel slices
+        slices=1 if preserve_order else session.database.config.scan_slices,
     ):
-        doc = hit["_source"]
-        # If email was delete/hidden and we're not doing an admin query, ignore it
-        if hide_deleted and doc.get("deleted", False):
-            continue
-        doc["id"] = doc["mid"]
-        if plugins.aaa.can_access_email(session, doc):
-            # Calculate gravatars if not present in source
-            if not metadata_only and "gravatar" not in doc:
-                doc["gravatar"] = gravatar(doc)
-            if not session.credentials:
-                doc = anonymize(doc)
-            if shorten:
-                doc["body"] = (doc["body"] or "")[:200]
-            trim_email(doc)
-            docs.append(doc)
+        doc = summarize_hit(session, hit, hide_deleted, metadata_only, shorten)
+        if doc:
+            if cursors:
+                doc["cursor"] = plugins.database.cursor_token(hit)
+            yield doc
             hits += 1
             if hits > query_limit:
                 break
-    return docs
 
 
-async def wordcloud(session, query_defuzzed):
+async def query_page(
+    session: plugins.session.SessionObject,
+    query_defuzzed,
+    page_size: int,
+    cursor: typing.Optional[str] = None,
+    shorten=False,
+    fields=None,
+) -> typing.Tuple[typing.List[dict], typing.Optional[str]]:
+    """
+    Fetches a single page of search results, newest emails first, starting after the continuation token if given.
+    Returns the emails along with the token for the next page, or None if this was the last page.
+    Raises ValueError if the token is not valid.
+    """
+    assert session.database, DATABASE_NOT_CONNECTED
+    search_after = plugins.database.parse_cursor_token(cursor) if cursor else None
+    es_query: typing.Dict[str, typing.Any] = {
+        "query": {"bool": plugins.aaa.restrict_query(session, query_defuzzed)},
+        "sort": [{"epoch": {"order": "desc"}}],
+    }
+    project_source(es_query, fields=fields, shorten=shorten)
+    docs: typing.List[dict] = []
+    last_hit: dict = {}
+    # Read one more than a page, so there is only a next page if there are more emails to show on it
+    async for hit in session.database.scan(
+        query=es_query, preserve_order=True, size=page_size + 1, search_after=search_after
+    ):
+        doc = summarize_hit(session, hit, shorten=shorten)
+        if doc:
+            if len(docs) >= page_size:
+                return docs, plugins.database.cursor_token(last_hit)
+            docs.append(doc)
+            last_hit = hit
+    return docs, None
+
+
+def summarize_thread(thread: dict, docs_by_mid: typing.Dict[str, dict]) -> dict:
+    """Summarizes a thread built by ThreadConstructor in the same way as thread_summaries does"""
+    epochs = []
+    authors = set()
+    todo = [thread]
+    while todo:
+        xemail = todo.pop()
+        todo.extend(xemail["children"])
+        epochs.append(xemail["epoch"] or 0)
+        authors.add(docs_by_mid.get(xemail["tid"], {}).get("from"))
+    return {
+        "tid": thread["tid"],
+        "subject": thread["subject"],
+        "list_raw": docs_by_mid.get(thread["tid"], {}).get("list_raw"),
+        "replies": len(epochs) - 1,
+        "participants": len(authors),
+        "first_epoch": min(epochs),
+        "last_epoch": max(epochs),
+    }
+
+
+async def thread_summaries(
+    session: plugins.session.SessionObject, query_defuzzed, limit=THREAD_SUMMARY_LIMIT
+) -> typing.Dict[str, typing.Any]:
     """
-    Wordclouds via significant terms query in ES
+    Summarizes the threads of a search in ES, as one row per thread with the root subject, reply count,
+    participant count and first/last activity, grouped on the thread ID the archiver stores with each email.
+    This does not need to fetch the emails themselves, except for those without thread information,
+    which are threaded by ThreadConstructor instead.
+    Returns the rows, most recently active first, along with the number of emails and participants.
+    """
+    assert session.database, DATABASE_NOT_CONNECTED
+    query_bool = plugins.aaa.restrict_query(session, query_defuzzed)
+    query_bool = dict(query_bool, must_not=list(query_bool.get("must_not", [])) + [{"term": {"deleted": True}}])
+    res = await session.database.search(
+        size=0,
+        body={
+            "query": {"bool": query_bool},
+            "track_total_hits": True,
+            "aggs": {
+                "threads": {
+                    "terms": {"field": "thread", "size": limit, "exclude": [""], "order": {"last": "desc"}},
+                    "aggs": {
+                        "first": {"min": {"field": "epoch"}},
+                        "last": {"max": {"field": "epoch"}},
+                        "participants": {"cardinality": {"field": "from_raw"}},
+                        "root": {
+                            "top_hits": {
+                                "size": 1,
+                                "sort": [{"epoch": {"order": "asc"}}],
+                                "_source": ["subject", "mid", "list_raw"],
+                            }
+                        },
+                    },
+                },
+                "numparts": {"cardinality": {"field": "from_raw"}},
+                "authors": {"terms": {"field": "from_raw", "size": 10}},
+            },
+        },
+    )
+    aggs = res["aggregations"]
+    rows = []
+    for bucket in aggs["threads"]["buckets"]:
+        root = bucket["root"]["hits"]["hits"][0]["_source"]
+        rows.append(
+            {
+                "tid": bucket["key"],
+                "subject": (root.get("subject") or "").replace("\n", ""),
+                "list_raw": root.get("list_raw"),
+                "replies": bucket["doc_count"] - 1,
+                "participants": bucket["participants"]["value"],
+                "first_epoch": int(bucket["first"]["value"] or 0),
+                "last_epoch": int(bucket["last"]["value"] or 0),
+            }
+        )
+
+    # Older emails may not have been archived with thread information, so thread those the old way
+    unthreaded = await query(
+        session,
+        dict(query_defuzzed, filter=list(query_defuzzed.get("filter", [])) + [NO_THREAD_INFO]),
+        query_limit=limit,
+        fields=THREAD_FIELDS,
+    )
+    if unthreaded:
+        docs_by_mid = {doc["mid"]: doc for doc in unthreaded}
+        threads, _authors = ThreadConstructor(unthreaded).construct()
+        rows.extend(summarize_thread(thread, docs_by_mid) for thread in threads)
+        rows.sort(key=lambda row: row["last_epoch"], reverse=True)
+
+    authors = {}
+    for bucket in aggs["authors"]["buckets"]:
+        author = bucket["key"]
+        if not session.credentials:
+            author = anonymize({"from": author})["from"]
+        authors[author] = bucket["doc_count"]
+    return {
+        "threads": rows[:limit],
+        "hits": res["hits"]["total"]["value"],
+        "numparts": aggs["numparts"]["value"],
+        "authors": authors,
+    }
+
+
+async def wordcloud(session, query_defuzzed, sample_size=0):
+    """
+    Wordclouds via significant terms query in ES.
+    If a sample size is given, only the top that many emails per shard are considered.
     """
     wc = {}
+    aggs = {"cloud": {"significant_terms": {"field": "subject", "size": 10}}}
+    if sample_size:
+        aggs = {"sample": {"sampler": {"shard_size": sample_size}, "aggs": aggs}}
     res = await session.database.search(
         body={
             "size": 0,
-            "query": {"bool": query_defuzzed},
-            "aggregations": {
-                "cloud": {"significant_terms": {"field": "subject", "size": 10}}
-            },
+            "query": {"bool": plugins.aaa.restrict_query(session, query_defuzzed)},
+            "aggregations": aggs,
         }
     )
 
-    for hit in res["aggregations"]["cloud"]["buckets"]:
+    cloud = res["aggregations"]["sample"]["cloud"] if sample_size else res["aggregations"]["cloud"]
+    for hit in cloud["buckets"]:
         wc[hit["key"]] = hit["doc_count"]
 
     return wc
@@ -384,12 +827,16 @@ async def get_list_stats(session, maxage="90d", admin=False):
     Fetches a list of all mailing lists available (and visible).
     Use the admin flag to override AAA and see everything
     """
+    assert session.database, DATABASE_NOT_CONNECTED
     daterange = {"gt": "now-%s" % maxage, "lt": "now+1d"}
-    res = session.database.search(
-        index=session.DB.dbs.mbox,
+    query_bool = {"must": [{"range": {"date": daterange}}]}
+    if not admin:
+        query_bool = plugins.aaa.restrict_query(session, query_bool)
+    res = await session.database.search(
+        index=session.database.dbs.mbox,
         size=0,
         body={
-            "query": {"bool": {"must": [{"range": {"date": daterange}}]}},
+            "query": {"bool": query_bool},
             "aggs": {"listnames": {"terms": {"field": "list_raw", "size": 10000}}},
         },
     )
@@ -414,61 +861,75 @@ async def get_list_stats(session, maxage="90d", admin=False):
 async def get_activity_span(session, query_defuzzed):
     """ Fetches the activity span of a search as well as active months within that span """
 
-    # Fetch any private lists included in search results
-    fuzz_private_only = dict(query_defuzzed)
-    fuzz_private_only["filter"] = [{"term": {"private": True}}]
+    # Plain list views can be answered from the monthly rollups, if available
+    list_clause = plugins.rollups.list_only_query(query_defuzzed)
+    if list_clause and session.server.data.rollups:
+        return await plugins.rollups.get_activity_span(session, list_clause)
+
+    # Get oldest and youngest doc in single scan, as well as a monthly histogram
+    span_aggs = {
+        "first": {"min": {"field": "epoch"}},
+        "last": {"max": {"field": "epoch"}},
+        "active_months": {
+            "date_histogram": {
+                "field": "date",
+                "calendar_interval": "month",
+                "format": "yyyy-MM"
+            }
+        }
+    }
+
+    # In the same go, fetch any private lists included in search results, and the span of
+    # public emails only, so we can pick the right one without a second round trip.
     res = await session.database.search(
         index=session.database.dbs.mbox,
         size=0,
         body={
-            "query": {"bool": fuzz_private_only},
-            "aggs": {"listnames": {"terms": {"field": "list_raw", "size": 10000}}},
+            "query": {"bool": query_defuzzed},
+            "aggs": {
+                "private_only": {
+                    "filter": {"term": {"private": True}},
+                    "aggs": {"listnames": {"terms": {"field": "list_raw", "size": 10000}}},
+                },
+                "public_only": {
+                    "filter": {"term": {"private": False}},
+                    "aggs": span_aggs,
+                },
+                **span_aggs,
+            },
         },
     )
+    aggs = res["aggregations"]
     private_lists_found = []
-    for entry in res["aggregations"]["listnames"]["buckets"]:
+    for entry in aggs["private_only"]["listnames"]["buckets"]:
         listname = entry["key"].lower()
         private_lists_found.append(listname)
 
-    # If we can access all private lists found, or if no private lists, we can do a complete search.
-    # If not, we adjust the search here to only include public emails OR private lists we can access.
+    # If we can access all private lists found, or if no private lists, we can use the complete search.
+    # If not, we use the public-only results or search again for public emails OR private lists we can access.
     private_lists_accessible = []
     for listname in private_lists_found:
         if plugins.aaa.can_access_list(session, listname):
             private_lists_accessible.append(listname)
-    
-    # If we can't access all private lists found, either only public emails or lists we can access.
-    if not private_lists_accessible:  # No private lists accessible, just filter for public
-        query_defuzzed["filter"] = [{"term": {"private": False}}]
+
+    if not private_lists_accessible:  # No private lists accessible, just use public
+        aggs = aggs["public_only"]
     elif private_lists_found != private_lists_accessible:  # Some private lists, search for public OR those..
+        query_defuzzed = dict(query_defuzzed)
         query_defuzzed["filter"] = [
             {"bool": {"should": [{"term": {"private": False}}, {"terms": {"list_raw": private_lists_accessible}}]}}
         ]
-
-    # Get oldest and youngest doc in single scan, as well as a monthly histogram
-    res = await session.database.search(
-        index=session.database.dbs.mbox,
-        size=0,
-        body={"query": {"bool": query_defuzzed},
-            "aggs": {
-                "first": {"min": {"field": "epoch"}},
-                "last": {"max": {"field": "epoch"}},
-                "active_months": {
-                    "date_histogram": {
-                        "field": "date",
-                        "calendar_interval": "month",
-                        "format": "yyyy-MM"
-                    }
-                }
-            },
-        }
-    )
+        res = await session.database.search(
+            index=session.database.dbs.mbox,
+            size=0,
+            body={"query": {"bool": query_defuzzed}, "aggs": span_aggs},
+        )
+        aggs = res["aggregations"]
 
     oldest = datetime.datetime.fromtimestamp(0)
     youngest = datetime.datetime.fromtimestamp(0)
     monthly_activity = {}
-    if res["aggregations"]:
-        aggs = res["aggregations"]
+    if aggs:
         oldest = datetime.datetime.fromtimestamp(aggs["first"]["value"] or 0)
         youngest = datetime.datetime.fromtimestamp(aggs["last"]["value"] or 0)
         for bucket in aggs["active_months"].get("buckets", []):
@@ -478,6 +939,46 @@ async def get_activity_span(session, query_defuzzed):
     return oldest, youngest, monthly_activity
 
 
+class SubQuery:
+    """A database request to be run alongside others through fan_out"""
+
+    def __init__(self, request: typing.Awaitable, timeout: typing.Optional[float] = None, optional: bool = False):
+        self.request = request
+        self.timeout = timeout
+        self.optional = optional
+
+
+async def fan_out(**queries: SubQuery) -> typing.Dict[str, typing.Any]:
+    """
+    Runs several independent database requests at the same time, each with its own deadline.
+    Optional requests that fail or miss their deadline are returned as None, while
+    failing required requests cancel the rest and raise the error.
+    """
+
+    async def run(name: str, query: SubQuery):
+        if not query.optional:
+            return await asyncio.wait_for(query.request, timeout=query.timeout)
+        try:
+            return await asyncio.wait_for(query.request, timeout=query.timeout)
+        except asyncio.TimeoutError:
+            return None
+        except asyncio.CancelledError:  # Still an Exception before Python 3.8
+            raise
+        # Whatever went wrong, the response can do without this part
+        except Exception as e:
+            print("Optional query %s failed: %s: %s" % (name, type(e).__name__, e))
+            return None
+
+    tasks = [asyncio.ensure_future(run(name, query)) for name, query in queries.items()]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return dict(zip(queries.keys(), results))
+
+
 class ThreadConstructor:
     def __init__(self, emails: typing.List[typing.Dict]):
         self.emails = emails
@@ -543,6 +1044,40 @@ class ThreadConstructor:
         return None
 
 
+def make_etag(session: plugins.session.SessionObject, *parts) -> str:
+    """
+    Makes an ETag from the parts identifying a response, and the access level of the user.
+    The tag is weak, as the same response may be sent with different content encodings.
+    """
+    digest = hashlib.sha256(
+        json.dumps([plugins.aaa.access_scope(session), *parts]).encode("utf-8")
+    ).hexdigest()
+    return 'W/"%s"' % digest[:40]
+
+
+def cache_headers(session: plugins.session.SessionObject, etag: str, max_age: int) -> typing.Dict[str, str]:
+    """Returns the caching headers for an archived object. Only anonymous responses can be shared by proxies"""
+    visibility = "private" if session.credentials else "public"
+    return {
+        "ETag": etag,
+        "Cache-Control": f"{visibility}, max-age={max_age}",
+        "Vary": "Cookie",
+    }
+
+
+def is_not_modified(request: aiohttp.web.BaseRequest, etag: str) -> bool:
+    """Checks if the client already has the version of an object that matches an ETag, using weak comparison"""
+    if_none_match = request.headers.get("If-None-Match", "")
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == opaque_tag:
+            return True
+    return False
+
+
 def gravatar(eml):
     """Generates a gravatar hash from an email address"""
     if isinstance(eml, str):
@@ -19,33 +19,87 @@
 
 import asyncio
 import concurrent.futures
+import functools
+import time
+import typing
 
 DEBUG = False
 
 
+class LaneCounters:
+    """Counters for the tasks sent to a single executor"""
+
+    def __init__(self):
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def as_dict(self) -> dict:
+        finished = self.completed + self.failed
+        return {
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "total_time": round(self.total_time, 3),
+            "average_time": round(self.total_time / finished, 5) if finished else 0.0,
+            "max_time": round(self.max_time, 3),
+        }
+
+
 class ExecutorPool:
     """A pool of runners for offloading blocking processes to threads, so that async processing can continue"""
 
-    def __init__(self, threads=None):
+    def __init__(self, threads=None, processes=0):
         # If no thread count is specified, will default to: min(32, os.cpu_count() + 4)
         self.threads = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        # CPU-heavy tasks can be sent to sub-processes instead, to get around the GIL. Disabled if set to 0.
+        self.processes: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+        if processes:
+            self.processes = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        self.counters = {
+            "threads": LaneCounters(),
+            "processes": LaneCounters(),
+        }
 
     async def run(self, func, *args, **kwargs):
-        if DEBUG:
-            print("[Runner] initiating runner")
-        runner = self.threads.submit(func, *args, **kwargs)
+        """Runs a blocking task in a thread and returns its result"""
+        return await self.execute(self.threads, self.counters["threads"], func, *args, **kwargs)
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """
+        Runs a CPU-heavy task in the process pool, if enabled, or in a thread otherwise.
+        The function, its arguments and its result must be picklable.
+        """
+        if self.processes:
+            return await self.execute(self.processes, self.counters["processes"], func, *args, **kwargs)
+        return await self.run(func, *args, **kwargs)
+
+    @staticmethod
+    async def execute(executor: concurrent.futures.Executor, counters: LaneCounters, func, *args, **kwargs):
         if DEBUG:
             print("[Runner] Waiting for task %r to finish" % func)
-        while runner.running():
-            await asyncio.sleep(0.01)
+        loop = asyncio.get_running_loop()
+        counters.pending += 1
+        start = time.time()
         try:
-            rv = runner.result()
-        except Exception as e:
-            rv = e
-        if DEBUG:
-            print("[Runner] Done with task %r, put runner back in queue" % func)
-        if isinstance(rv, BaseException):
+            rv = await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+            counters.completed += 1
+        except Exception:
             if DEBUG:
                 print("[Runner] Task %r encountered an exception during run." % func)
-            raise rv
+            counters.failed += 1
+            raise
+        finally:
+            counters.pending -= 1
+            task_time = time.time() - start
+            counters.total_time += task_time
+            counters.max_time = max(counters.max_time, task_time)
+        if DEBUG:
+            print("[Runner] Done with task %r" % func)
         return rv
+
+    def stats(self) -> dict:
+        """Returns the task counters for each lane"""
+        return {lane: counters.as_dict() for lane, counters in self.counters.items()}
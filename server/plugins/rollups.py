@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the rollup library for Pony Mail codename Foal.
+It reads the monthly per-list summaries that the archiver keeps up to date
+(see tools/plugins/rollup.py), so list-wide statistics can be gathered
+without aggregating every single email.
+"""
+
+import calendar
+import collections
+import datetime
+import re
+import time
+import typing
+
+import elasticsearch
+
+import plugins.aaa
+import plugins.database
+import plugins.server
+import plugins.session
+
+# Number of rollup documents to look at for recent list activity (lists x months x public/private)
+MAX_RECENT_ROLLUPS = 10000
+# Number of rollup documents to add up the authors of a search from, larger spans are left to the emails
+MAX_SPAN_ROLLUPS = 1000
+# Number of authors to keep per rollup when recomputing one
+MAX_AUTHORS = 10000
+# Date range bounds that fall on the start or end of a month, as produced by the defuzzer
+MONTH_START_RE = re.compile(r"^(\d{4})[-/](\d{2})[-/]01(?:\|\|/M| 00:00:00)$")
+MONTH_END_RE = re.compile(r"^(\d{4})[-/](\d{2})[-/](\d{2})(\|\|/M| 23:59:59)$")
+
+
+async def available(db: plugins.database.Database) -> bool:
+    """Determines whether the rollup index has been set up (see tools/rebuild-rollups.py)"""
+    return bool(await db.call(db.client.indices.exists, index=db.dbs.rollup))
+
+
+def list_only_query(query_defuzzed: dict) -> typing.Optional[dict]:
+    """Returns the list clause of a search that filters on nothing but lists, or None if rollups cannot answer it"""
+    must = query_defuzzed.get("must", [])
+    if set(query_defuzzed.keys()) != {"must"} or len(must) != 1:
+        return None
+    clause_type, clause = next(iter(must[0].items()))
+    if clause_type in ("term", "wildcard") and list(clause.keys()) == ["list_raw"]:
+        return must[0]
+    return None
+
+
+def month_range_query(query_defuzzed: dict) -> typing.Optional[typing.Tuple[dict, str, str]]:
+    """
+    Returns the list clause and the first and last month (YYYY-MM) of a search that filters on nothing but
+    lists and whole months, or None if rollups cannot answer it
+    """
+    must = query_defuzzed.get("must", [])
+    if set(query_defuzzed.keys()) != {"must"} or len(must) != 2:
+        return None
+    list_clause = list_only_query({"must": must[:1]})
+    daterange = must[1].get("range", {}).get("date")
+    if not list_clause or not daterange:
+        return None
+    start = MONTH_START_RE.match(str(daterange.get("gt") or daterange.get("gte") or ""))
+    end = MONTH_END_RE.match(str(daterange.get("lt") or daterange.get("lte") or ""))
+    if not start or not end:
+        return None
+    year, month, day, suffix = end.groups()
+    # Unless rounded to the month, the range has to end on the last day of its month
+    if suffix != "||/M" and int(day) != calendar.monthrange(int(year), int(month))[1]:
+        return None
+    return list_clause, "%s-%s" % start.groups(), "%s-%s" % (year, month)
+
+
+async def get_authors(
+    session: plugins.session.SessionObject, list_clause: dict, first_month: str, last_month: str
+) -> typing.Optional[typing.Dict[str, int]]:
+    """
+    Adds up the authors of one or more lists over a span of months, as {author: number of emails}.
+    Returns None if the span covers too many rollups.
+    """
+    assert session.database, "Database not connected!"
+    query = {"must": [list_clause, {"range": {"month": {"gte": first_month, "lte": last_month}}}]}
+    res = await session.database.search(
+        index=session.database.dbs.rollup,
+        size=MAX_SPAN_ROLLUPS,
+        body={
+            "query": {"bool": plugins.aaa.restrict_query(session, query)},
+            "_source": ["authors"],
+            "track_total_hits": MAX_SPAN_ROLLUPS + 1,
+        },
+    )
+    if res["hits"]["total"]["value"] > MAX_SPAN_ROLLUPS:
+        return None
+    authors: typing.Counter[str] = collections.Counter()
+    for hit in res["hits"]["hits"]:
+        authors.update(hit["_source"].get("authors") or {})
+    return dict(authors)
+
+
+async def get_activity_span(session: plugins.session.SessionObject, list_clause: dict):
+    """Fetches the activity span of one or more lists, as well as the active months within it"""
+    assert session.database, "Database not connected!"
+    res = await session.database.search(
+        index=session.database.dbs.rollup,
+        size=0,
+        body={
+            "query": {"bool": plugins.aaa.restrict_query(session, {"must": [list_clause]})},
+            "aggs": {
+                "first": {"min": {"field": "first"}},
+                "last": {"max": {"field": "last"}},
+                "active_months": {
+                    "terms": {"field": "month", "size": 10000, "order": {"_key": "asc"}},
+                    "aggs": {"messages": {"sum": {"field": "messages"}}},
+                },
+            },
+        },
+    )
+    aggs = res["aggregations"]
+    oldest = datetime.datetime.fromtimestamp(aggs["first"]["value"] or 0)
+    youngest = datetime.datetime.fromtimestamp(aggs["last"]["value"] or 0)
+    monthly_activity = {}
+    for bucket in aggs["active_months"]["buckets"]:
+        if bucket["messages"]["value"]:
+            monthly_activity[bucket["key"]] = int(bucket["messages"]["value"])
+    return oldest, youngest, monthly_activity
+
+
+async def get_lists(db: plugins.database.Database, since: int, limit: int = 8192) -> dict:
+    """
+    Fetches all archived lists, whether they are private (have any private emails),
+    and the number of emails sent to them since a given epoch
+    """
+    res = await db.search(
+        index=db.dbs.rollup,
+        size=0,
+        body={
+            "aggs": {
+                "per_list": {
+                    "terms": {"field": "list_raw", "size": limit},
+                    "aggs": {"private": {"max": {"field": "private"}}},
+                }
+            }
+        },
+    )
+    lists = {}
+    for bucket in res["aggregations"]["per_list"]["buckets"]:
+        list_name = bucket["key"].strip("<>").replace(".", "@", 1)
+        lists[list_name] = {
+            "count": 0,
+            "private": bool(bucket["private"]["value"]),
+        }
+
+    # Count recent emails day by day, using the months that saw activity after $since
+    res = await db.search(
+        index=db.dbs.rollup,
+        size=MAX_RECENT_ROLLUPS,
+        body={
+            "query": {"range": {"last": {"gte": since}}},
+            "_source": ["list_raw", "month", "daily"],
+        },
+    )
+    for hit in res["hits"]["hits"]:
+        rollup = hit["_source"]
+        list_name = rollup["list_raw"].strip("<>").replace(".", "@", 1)
+        if list_name not in lists:
+            continue
+        year, month = (int(x) for x in rollup["month"].split("-", 1))
+        days_in_month = calendar.monthrange(year, month)[1]
+        for day, count in enumerate(rollup["daily"][:days_in_month], start=1):
+            # Count the days that end after $since
+            if count and calendar.timegm((year, month, day, 0, 0, 0)) + 86400 > since:
+                lists[list_name]["count"] += count
+    return lists
+
+
+def rollup_id(list_raw: str, month: str, private: bool) -> str:
+    """Returns the document ID of a rollup, e.g. <dev.example.org>/2021-05/public (see tools/plugins/rollup.py)"""
+    return "%s/%s/%s" % (list_raw, month, "private" if private else "public")
+
+
+def mark_stale(server: plugins.server.BaseServer, list_raw: str, epoch: int):
+    """
+    Queues the rollups of a list for the month of an email to be recomputed by the background tasks.
+    The archiver only ever adds emails to rollups, so this is needed when emails are deleted or moved.
+    """
+    if server.data.rollups:
+        tm = time.gmtime(epoch)
+        server.data.stale_rollups.add((list_raw, "%04u-%02u" % (tm.tm_year, tm.tm_mon)))
+
+
+async def rebuild(db: plugins.database.Database, list_raw: str, month: str) -> bool:
+    """
+    Recomputes the public and private rollups of a list for a month from its emails.
+    Returns False if the archiver updated one of them in the meantime, in which case it should be tried again.
+    """
+    # Note the versions first, so updates made by the archiver while we count are not overwritten
+    versions = {}
+    for private in (False, True):
+        res = await db.get(index=db.dbs.rollup, id=rollup_id(list_raw, month, private), _source=False, ignore=404)
+        versions[private] = res if res.get("found") else None
+
+    year, mon = (int(x) for x in month.split("-", 1))
+    start = calendar.timegm((year, mon, 1, 0, 0, 0))
+    end = start + calendar.monthrange(year, mon)[1] * 86400
+    res = await db.search(
+        index=db.dbs.mbox,
+        size=0,
+        body={
+            "query": {
+                "bool": {
+                    "filter": [{"term": {"list_raw": list_raw}}, {"range": {"epoch": {"gte": start, "lt": end}}}],
+                    "must_not": [{"term": {"deleted": True}}],
+                }
+            },
+            "aggs": {
+                "private": {
+                    "terms": {"field": "private", "missing": False, "size": 2},
+                    "aggs": {
+                        "first": {"min": {"field": "epoch"}},
+                        "last": {"max": {"field": "epoch"}},
+                        # Without thread information, emails that do not reply to anything count as new threads
+                        "threads": {
+                            "filter": {
+                                "bool": {
+                                    "should": [
+                                        {"term": {"top": True}},
+                                        {
+                                            "bool": {
+                                                "must_not": [
+                                                    {"exists": {"field": "top"}},
+                                                    {"exists": {"field": "in-reply-to"}},
+                                                ]
+                                            }
+                                        },
+                                    ]
+                                }
+                            }
+                        },
+                        "authors": {"terms": {"field": "from_raw", "size": MAX_AUTHORS}},
+                        "daily": {"histogram": {"field": "epoch", "interval": 86400, "min_doc_count": 1}},
+                    },
+                }
+            },
+        },
+    )
+    rollups = {}
+    for bucket in res["aggregations"]["private"]["buckets"]:
+        daily = [0] * 31
+        for day in bucket["daily"]["buckets"]:
+            daily[int(day["key"] - start) // 86400] = day["doc_count"]
+        private = bucket["key_as_string"] == "true"
+        rollups[private] = {
+            "list_raw": list_raw,
+            "private": private,
+            "month": month,
+            "messages": bucket["doc_count"],
+            "threads": bucket["threads"]["doc_count"],
+            "authors": {author["key"]: author["doc_count"] for author in bucket["authors"]["buckets"]},
+            "daily": daily,
+            "first": int(bucket["first"]["value"]),
+            "last": int(bucket["last"]["value"]),
+        }
+
+    for private, version in versions.items():
+        doc_id = rollup_id(list_raw, month, private)
+        if version:
+            concurrency = {"if_seq_no": version["_seq_no"], "if_primary_term": version["_primary_term"]}
+        else:
+            concurrency = {"op_type": "create"}
+        try:
+            if private in rollups:
+                await db.index(index=db.dbs.rollup, id=doc_id, body=rollups[private], **concurrency)
+            elif version:
+                await db.delete(index=db.dbs.rollup, id=doc_id, **concurrency)
+        except elasticsearch.ConflictError:
+            return False
+    return True
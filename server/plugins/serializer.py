@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the JSON serializer library for Pony Mail codename Foal.
+It uses orjson if installed, and the standard json library otherwise.
+"""
+
+import json
+import typing
+
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+
+def dumps(output: typing.Any, pretty: bool = False) -> bytes:
+    """Serializes an object to JSON as UTF-8 bytes. Compact unless pretty-printing is asked for."""
+    if HAVE_ORJSON:
+        try:
+            return orjson.dumps(output, option=orjson.OPT_INDENT_2 if pretty else 0)
+        except TypeError:
+            pass  # Not something orjson can handle (e.g. very large integers), use the standard encoder
+    if pretty:
+        return json.dumps(output, indent=2).encode("utf-8")
+    return json.dumps(output, separators=(",", ":")).encode("utf-8")
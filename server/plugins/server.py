@@ -23,22 +23,31 @@ import typing
 import aiohttp
 from elasticsearch import AsyncElasticsearch
 
+import plugins.cache
 import plugins.configuration
+import plugins.database
 import plugins.offloader
 
+if typing.TYPE_CHECKING:
+    import plugins.exports  # Imports this module in turn
+
 
 class Endpoint:
     exec: typing.Callable
+    needs_database: bool
 
-    def __init__(self, executor):
+    def __init__(self, executor, needs_database=True):
         self.exec = executor
+        self.needs_database = needs_database
 
 
 class StreamingEndpoint:
     exec: typing.Callable
+    needs_database: bool
 
-    def __init__(self, executor):
+    def __init__(self, executor, needs_database=True):
         self.exec = executor
+        self.needs_database = needs_database
 
 
 class BaseServer:
@@ -47,8 +56,11 @@ class BaseServer:
     config: plugins.configuration.Configuration
     server: typing.Optional[aiohttp.web.Server]
     data: plugins.configuration.InterData
-    handlers: typing.Dict[str, Endpoint]
+    handlers: typing.Dict[str, typing.Union[Endpoint, StreamingEndpoint]]
     database: AsyncElasticsearch
-    dbpool: asyncio.Queue
+    dbpool: plugins.database.DatabasePool
     runners: plugins.offloader.ExecutorPool
-    streamlock: asyncio.Lock
+    export_slots: typing.Optional[asyncio.Semaphore]
+    stats_cache: plugins.cache.ResponseCache
+    wordcloud_cache: plugins.cache.ResponseCache
+    exports: "plugins.exports.ExportCache"
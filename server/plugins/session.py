@@ -17,6 +17,7 @@
 
 """This is the user session handler for PyPony"""
 
+import contextlib
 import http.cookies
 import time
 import typing
@@ -88,6 +89,22 @@ class SessionObject:
             self.cookie = str(uuid.uuid4())
             self.cid = None
 
+    @contextlib.asynccontextmanager
+    async def open_database(self, needed=True):
+        """
+        Checks out a database connection from the pool for the duration of the block, and puts
+        it back afterwards. Does nothing if not needed or if the session already holds one.
+        """
+        if not needed or self.database:
+            yield self.database
+            return
+        self.database = await self.server.dbpool.get()
+        try:
+            yield self.database
+        finally:
+            self.server.dbpool.put(self.database)
+            self.database = None
+
 
 async def get_session(
     server: plugins.server.BaseServer, request: aiohttp.web.BaseRequest
@@ -116,7 +133,7 @@ async def get_session(
             # Make a copy so we don't have a race condition with the database pool object
             # In case the session is used twice within the same loop
             session = copy.copy(x_session)
-            session.database = await server.dbpool.get()
+            session.database = None
             if "X-Forwarded-Host" in request.headers:
                 session.host = request.headers["X-Forwarded-Host"]
             else:
@@ -126,13 +143,13 @@ async def get_session(
             # Do we need to update the timestamp in ES?
             if (now - session.last_accessed) > FOAL_SAVE_SESSION_INTERVAL:
                 session.last_accessed = now
-                await save_session(session)
+                async with session.open_database():
+                    await save_session(session)
 
             return session
 
     # If not in local memory, start a new session object
     session = SessionObject(server)
-    session.database = await server.dbpool.get()
     if "X-Forwarded-Host" in request.headers:
         session.host = request.headers["X-Forwarded-Host"]
     else:
@@ -140,7 +157,15 @@ async def get_session(
     session.remote = request.remote or "??"
 
     # If a cookie was supplied, look for a session object in ES
-    if session_id and session.database:
+    if session_id:
+        async with session.open_database():
+            await load_session(server, session, session_id, now)
+    return session
+
+
+async def load_session(server: plugins.server.BaseServer, session: SessionObject, session_id: str, now: int):
+    """Looks up a session cookie and its account in the database, filling in the session object if valid"""
+    if session.database:
         try:
             session_doc = await session.database.get(
                 session.database.dbs.session, id=session_id
@@ -149,10 +174,10 @@ async def get_session(
             session.cookie = session_id
             # Check that this cookie ain't too old. If it is, delete it and return bare-bones session object
             if (now - last_update) > FOAL_MAX_SESSION_AGE:
-                session.database.delete(
+                await session.database.delete(
                     index=session.database.dbs.session, id=session_id
                 )
-                return session
+                return
 
             # Get CID and fecth the account data
             cid = session_doc["_source"]["cid"]
@@ -181,7 +206,6 @@ async def get_session(
 
         except plugins.database.DBError:
             pass
-    return session
 
 
 async def set_session(server: plugins.server.BaseServer, cid, **credentials):
@@ -197,14 +221,10 @@ async def set_session(server: plugins.server.BaseServer, cid, **credentials):
 
     # Grab temporary DB handle since session objects at init do not have this
     # We just need this to be able to save the session in ES.
-    session.database = await server.dbpool.get()
-
-    # Save session and account data
-    await save_session(session)
-    await save_credentials(session)
-
-    # Put DB handle back into the pool
-    server.dbpool.put_nowait(session.database)
+    async with session.open_database():
+        # Save session and account data
+        await save_session(session)
+        await save_credentials(session)
     return cookie["ponymail"].OutputString()
 
 
@@ -60,16 +60,19 @@ import netaddr
 
 if not __package__:
     from plugins import ponymailconfig
-    from plugins import generators, textlib
+    from plugins import generators, rollup, textlib
     from plugins.elastic import Elastic
 else:
     from .plugins import ponymailconfig
-    from .plugins import generators, textlib
+    from .plugins import generators, rollup, textlib
     from .plugins.elastic import Elastic
 
 # This is what we will default to if we are presented with emails without character sets and US-ASCII doesn't work.
 DEFAULT_CHARACTER_SET = 'utf-8'
 
+# Length of the body preview stored with each email, for list views
+PREVIEW_LENGTH = 200
+
 # Fetch config from same dir as archiver.py
 config = ponymailconfig.PonymailConfig()
 
@@ -584,6 +587,7 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
             ghash = hashlib.md5(mailaddr.encode("utf-8")).hexdigest()
 
             notes.append(["ARCHIVE: Email archived as %s at %u" % (document_id, time.time())])
+            body_text = body.unflow() if body else ""
 
             output_json = {
                 "from_raw": msg_metadata["from"],
@@ -603,7 +607,8 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
                 "private": private,
                 "references": msg_metadata["references"],
                 "in-reply-to": irt,
-                "body": body.unflow() if body else "",
+                "body": body_text,
+                "preview": body_text[:PREVIEW_LENGTH],
                 "html_source_only": body and body.html_as_source or False,
                 "attachments": attachments,
                 "forum": (lid or "").strip("<>").replace(".", "@", 1),
@@ -691,7 +696,7 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
                         body={"source": contents[key]},
                     )
 
-            elastic.index(
+            res = elastic.index(
                 index=elastic.db_mbox, id=ojson["mid"], body=ojson,
             )
 
@@ -704,6 +709,14 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
                     "source": mbox_source(raw_message),
                 },
             )
+            # Add to the monthly list rollup, unless we just replaced an email that was already counted
+            try:
+                rollup_exists = elastic.indices.exists(index=elastic.db_rollup)
+            except elasticsearch.exceptions.AuthorizationException:
+                rollup_exists = False
+            if rollup_exists and res.get("result") == "created":
+                elastic.es.update(index=elastic.db_rollup, **rollup.update_action(ojson))
+
             # Write to audit log
             try:
                 auditlog_exists = elastic.indices.exists(index=elastic.db_auditlog)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Utility for adding body previews to emails archived before previews were stored.
+    List views fall back to cutting previews out of the full body in ES until this has been run.
+"""
+
+import argparse
+
+from elasticsearch.helpers import scan
+
+import archiver
+from plugins.elastic import Elastic
+
+parser = argparse.ArgumentParser(description="Command line options.")
+parser.add_argument(
+    "--batch", dest="batch", type=int, default=500, help="Number of emails to update per bulk request"
+)
+parser.add_argument(
+    "--dry-run", dest="dry_run", action="store_true", help="Only count the emails that need a preview"
+)
+args = parser.parse_args()
+
+
+def missing_previews(elastic: Elastic):
+    """Yields bulk update actions for all emails without a preview"""
+    hits = scan(
+        client=elastic.es,
+        index=elastic.db_mbox,
+        query={"query": {"bool": {"must_not": [{"exists": {"field": "preview"}}]}}, "_source": ["body"]},
+    )
+    for hit in hits:
+        body = hit["_source"].get("body") or ""
+        yield {
+            "_op_type": "update",
+            "_index": elastic.db_mbox,
+            "_id": hit["_id"],
+            "doc": {"preview": body[: archiver.PREVIEW_LENGTH]},
+        }
+
+
+def main() -> None:
+    elastic: Elastic = Elastic()
+    if args.dry_run:
+        res = elastic.es.count(
+            index=elastic.db_mbox, body={"query": {"bool": {"must_not": [{"exists": {"field": "preview"}}]}}}
+        )
+        print("%u emails need a preview" % res["count"])
+        return
+    updated, errors = elastic.bulk(missing_previews(elastic), chunk_size=args.batch, raise_on_error=False)
+    print("All done! Added previews to %u emails, %u failed." % (updated, len(errors)))
+
+
+if __name__ == "__main__":
+    main()
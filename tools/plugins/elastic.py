@@ -45,6 +45,7 @@ class Elastic:
     db_notification:    str
     db_mailinglist:     str
     db_auditlog:        str
+    db_rollup:          str
 
     def __init__(self):
         # Fetch config
@@ -60,6 +61,7 @@ class Elastic:
         self.db_notification = self.dbname + '-notification'
         self.db_mailinglist = self.dbname + '-mailinglist'
         self.db_auditlog = self.dbname + '-auditlog'
+        self.db_rollup = self.dbname + '-rollup'
         self.db_version = 0
 
         dburl = config.get('elasticsearch', 'dburl', fallback=None)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Monthly per-list rollups for Pony Mail (Foal).
+Each rollup document summarizes the public or the private emails of one list in one month:
+  list_raw, private, month (YYYY-MM), messages, threads, authors ({author: count}),
+  daily (messages per day of the month), first and last (epochs).
+The archiver updates them one email at a time, and rebuild-rollups.py recomputes them from scratch.
+"""
+
+import time
+import typing
+
+# Updates (or creates) a rollup document with a single email
+UPDATE_SCRIPT = """
+def r = ctx._source;
+if (r.messages == null) {
+    r.list_raw = params.list_raw;
+    r.private = params.private;
+    r.month = params.month;
+    r.messages = 0;
+    r.threads = 0;
+    r.authors = [:];
+    r.daily = [];
+    for (int i = 0; i < 31; i++) { r.daily.add(0); }
+    r.first = params.epoch;
+    r.last = params.epoch;
+}
+r.messages += 1;
+if (params.top) { r.threads += 1; }
+r.authors[params.author] = r.authors.getOrDefault(params.author, 0) + 1;
+r.daily[params.day - 1] += 1;
+r.first = Math.min(r.first, params.epoch);
+r.last = Math.max(r.last, params.epoch);
+"""
+
+
+def rollup_id(list_raw: str, month: str, private: bool) -> str:
+    """Returns the document ID of a rollup, e.g. <dev.example.org>/2021-05/public"""
+    return "%s/%s/%s" % (list_raw, month, "private" if private else "public")
+
+
+def email_params(ojson: dict) -> typing.Dict[str, typing.Any]:
+    """Returns what a rollup needs to know about an archived email"""
+    epoch = int(ojson.get("epoch") or 0)
+    tm = time.gmtime(epoch)
+    return {
+        "list_raw": ojson["list_raw"],
+        "private": bool(ojson.get("private")),
+        "month": "%04u-%02u" % (tm.tm_year, tm.tm_mon),
+        "day": tm.tm_mday,
+        "epoch": epoch,
+        "author": ojson.get("from_raw") or ojson.get("from") or "",
+        # Without thread information, count emails that do not reply to anything as new threads
+        "top": bool(ojson.get("top", not ojson.get("in-reply-to"))),
+    }
+
+
+def update_action(ojson: dict) -> typing.Dict[str, typing.Any]:
+    """Returns the arguments for an ES update call that adds an email to its rollup"""
+    params = email_params(ojson)
+    return {
+        "id": rollup_id(params["list_raw"], params["month"], params["private"]),
+        "body": {
+            "scripted_upsert": True,
+            "script": {"source": UPDATE_SCRIPT, "params": params},
+            "upsert": {},
+        },
+        "retry_on_conflict": 5,
+    }
+
+
+class RollupBuilder:
+    """Builds rollup documents in memory from a stream of emails, in the same way UPDATE_SCRIPT does"""
+
+    def __init__(self):
+        self.rollups: typing.Dict[str, dict] = {}
+
+    def add(self, ojson: dict):
+        if ojson.get("deleted"):
+            return
+        params = email_params(ojson)
+        doc_id = rollup_id(params["list_raw"], params["month"], params["private"])
+        rollup = self.rollups.get(doc_id)
+        if rollup is None:
+            rollup = self.rollups[doc_id] = {
+                "list_raw": params["list_raw"],
+                "private": params["private"],
+                "month": params["month"],
+                "messages": 0,
+                "threads": 0,
+                "authors": {},
+                "daily": [0] * 31,
+                "first": params["epoch"],
+                "last": params["epoch"],
+            }
+        rollup["messages"] += 1
+        if params["top"]:
+            rollup["threads"] += 1
+        rollup["authors"][params["author"]] = rollup["authors"].get(params["author"], 0) + 1
+        rollup["daily"][params["day"] - 1] += 1
+        rollup["first"] = min(rollup["first"], params["epoch"])
+        rollup["last"] = max(rollup["last"], params["epoch"])
+
+    def documents(self) -> typing.Iterator[typing.Tuple[str, dict]]:
+        return iter(self.rollups.items())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Utility for (re)building the monthly per-list rollups from the archived emails.
+    Creates the rollup index if it does not exist yet. Once it does, the archiver keeps the
+    rollups up to date and the API server starts using them.
+"""
+
+import os
+
+import yaml
+from elasticsearch.helpers import scan
+
+from plugins.elastic import Elastic
+from plugins.rollup import RollupBuilder
+
+ROLLUP_FIELDS = ["list_raw", "private", "epoch", "from", "from_raw", "top", "in-reply-to", "deleted"]
+
+
+def create_index(elastic: Elastic) -> None:
+    mappings_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mappings.yaml")
+    mappings = yaml.safe_load(open(mappings_file, "r"))["rollup"]
+    elastic.es.indices.create(index=elastic.db_rollup, body={"mappings": mappings})
+    print("Created index %s" % elastic.db_rollup)
+
+
+def main() -> None:
+    elastic: Elastic = Elastic()
+    builder = RollupBuilder()
+    hits = scan(client=elastic.es, index=elastic.db_mbox, query={"_source": ROLLUP_FIELDS}, size=1000)
+    count = 0
+    for hit in hits:
+        builder.add(hit["_source"])
+        count += 1
+        if count % 100000 == 0:
+            print("Processed %u emails..." % count)
+
+    if not elastic.indices.exists(index=elastic.db_rollup):
+        create_index(elastic)
+    else:
+        elastic.es.delete_by_query(index=elastic.db_rollup, body={"query": {"match_all": {}}}, refresh=True)
+    actions = (
+        {"_op_type": "index", "_index": elastic.db_rollup, "_id": doc_id, "_source": doc}
+        for doc_id, doc in builder.documents()
+    )
+    indexed, _errors = elastic.bulk(actions)
+    print("All done! Rolled up %u emails into %u documents." % (count, indexed))
+
+
+if __name__ == "__main__":
+    main()